@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+"""
+Benchmarks for reindexing, querying, parsing, highlighting and startup, run against a synthetic knowledge base.
+
+Elasticsearch and the web are replaced with local stand-ins, so the results only depend on howdou itself
+and can be compared between commits, e.g.:
+
+    python -m howdou.benchmarks --sizes=1000,10000 --output=before.json
+    python -m howdou.benchmarks --sizes=1000,10000 --output=after.json --compare=before.json
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from six.moves import BaseHTTPServer, socketserver # pylint: disable=import-error
+
+from . import howdou
+from .howdou import HowDoU, get_parser, percentile, __version__
+
+WORDS = (
+    'list copy move delete find search replace sort count compress extract install upgrade remove '
+    'start stop restart enable disable mount format partition backup restore encrypt decrypt sign verify '
+    'file directory folder link process service package user group permission network port socket '
+    'database table index query column row branch commit merge rebase tag remote image container volume '
+    'python bash git docker postgres ubuntu ssh nginx cron systemd vim tar grep sed awk curl'
+).split()
+
+FORMATTERS = ('bash', 'python', 'sql', None)
+
+DEFAULT_SIZES = '1000,10000'
+
+class FakeIndices():
+
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, index, **kwargs): # pylint: disable=unused-argument
+        self.client.docs.setdefault(index, {})
+
+    def delete(self, index, **kwargs): # pylint: disable=unused-argument
+        self.client.docs.pop(index, None)
+
+    def refresh(self, index, **kwargs):
+        pass
+
+class FakeTransport():
+
+    def __init__(self):
+        from elasticsearch.serializer import JSONSerializer
+        self.serializer = JSONSerializer()
+
+class FakeElasticsearch():
+    """
+    An in-memory stand-in for the parts of the Elasticsearch client used by ElasticsearchBackend,
+    so the backend's own request building and response handling can be measured without a server.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.indices = FakeIndices(self)
+        self.transport = FakeTransport()
+        self.lock = threading.Lock()
+
+    def bulk(self, body, **kwargs): # pylint: disable=unused-argument
+        lines = iter(body.splitlines())
+        items = []
+        with self.lock:
+            for line in lines:
+                op_type, meta = list(json.loads(line).items())[0]
+                docs = self.docs.setdefault(meta['_index'], {})
+                status = 200
+                if op_type == 'delete':
+                    status = 200 if docs.pop(meta['_id'], None) is not None else 404
+                elif op_type == 'update':
+                    docs.setdefault(meta['_id'], {}).update(json.loads(next(lines))['doc'])
+                else:
+                    status = 200 if meta['_id'] in docs else 201
+                    docs[meta['_id']] = json.loads(next(lines))
+                items.append({op_type: {'_id': meta['_id'], 'status': status}})
+        return {'errors': False, 'items': items}
+
+    def msearch(self, body, **kwargs): # pylint: disable=unused-argument
+        responses = []
+        for header, search in zip(body[::2], body[1::2]):
+            if header['index'] not in self.docs:
+                responses.append({'status': 404, 'error': 'index_not_found_exception'})
+                continue
+            function_score = search['query']['function_score']
+            query_string = function_score['query']['query_string']
+            terms = set(howdou.tokenize(query_string['query']))
+            exact = query_string['default_operator'] == 'AND'
+            hits = []
+            for doc_id, doc in self.docs[header['index']].items():
+                tokens = howdou.tokenize(doc.get('questions') or '')
+                matched = terms.intersection(tokens)
+                if not matched or (exact and matched != terms):
+                    continue
+                score = float(len(matched)) * float(function_score['boost']) * (doc.get('weight') or 1)
+                source = dict((field, doc.get(field)) for field in search['_source'])
+                hits.append({'_id': doc_id, '_score': score, '_source': source})
+            hits.sort(key=lambda hit: -hit['_score'])
+            responses.append({'status': 200, 'hits': {'total': len(hits), 'hits': hits[:search['size']]}})
+        return {'responses': responses}
+
+SEARCH_PAGE = '<html><body>{links}</body></html>'
+
+SEARCH_LINK = '<div class="r"><a href="{url}questions/{id}/question-{id}">Question {id}</a></div>'
+
+QUESTION_PAGE = '''<html><body>
+<a class="post-tag">bash</a><a class="post-tag">linux</a>
+<div class="answer"><div class="post-text">
+<p>Use the following command to {words}:</p>
+<pre><code>{code}</code></pre>
+<p>See the manual for more options.</p>
+</div></div>
+</body></html>'''
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves a search results page linking to 10 questions, and a page for each question, mimicking the pages
+    howdou scrapes from the web.
+    """
+
+    def do_GET(self):
+        url = 'http://%s:%s/' % self.server.server_address[:2]
+        match = re.search(r'/questions/(\d+)/', self.path)
+        if match:
+            rng = random.Random(int(match.group(1)))
+            words = ' '.join(rng.choice(WORDS) for _ in range(5))
+            page = QUESTION_PAGE.format(words=words, code='%s --%s %s' % tuple(rng.choice(WORDS) for _ in range(3)))
+        else:
+            offset = zlib.crc32(self.path.encode('utf-8')) % 1000
+            page = SEARCH_PAGE.format(links='\n'.join(SEARCH_LINK.format(url=url, id=offset + i) for i in range(10)))
+        data = page.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+class StandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+@contextlib.contextmanager
+def stand_in_web():
+    """
+    Runs the stand-in web server on a free local port, pointing howdou's searches at it while active.
+    """
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    search_url = howdou.SEARCH_URL
+    howdou.SEARCH_URL = 'http://%s:%s/search?q=site:{0}%%20{1}' % server.server_address[:2]
+    try:
+        yield server
+    finally:
+        howdou.SEARCH_URL = search_url
+        server.shutdown()
+        server.server_close()
+
+def generate_kb(directory, entries, files=10, seed=0):
+    """
+    Writes a knowledge base with the given number of entries, split across a main file and the given number
+    of included files, and returns the main file's name along with a sample of the questions asked.
+    """
+    rng = random.Random(seed)
+    yaml = howdou.get_yaml()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    main_fn = os.path.join(directory, 'howdou.yml')
+    include_fns = [os.path.join(directory, 'include-%i.yml' % i) for i in range(files)]
+    per_file = [[] for _ in range(files + 1)]
+    questions = []
+    for i in range(entries):
+        question = 'how to %s' % ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 6)))
+        questions.append(question)
+        answer = {
+            'weight': rng.randint(1, 10),
+            'date': '2017-2-1',
+            'source': 'https://example.com/%i' % i,
+            'text': '\n'.join('%s --%s %s' % tuple(rng.choice(WORDS) for _ in range(3)) for _ in range(rng.randint(1, 4))),
+        }
+        formatter = rng.choice(FORMATTERS)
+        if formatter:
+            answer['formatter'] = formatter
+        per_file[i % (files + 1)].append({'questions': [question, question.replace('how to ', '')], 'answers': [answer]})
+    per_file[0].extend({'include': fn} for fn in include_fns)
+    for fn, items in zip([main_fn] + include_fns, per_file):
+        with io.open(fn, 'w', encoding='utf-8') as fout:
+            yaml.dump(items, fout, default_flow_style=False, indent=4)
+    return main_fn, rng.sample(questions, min(len(questions), 200))
+
+def get_howdou(tmp_dir, backend, *extra_args):
+    args = vars(get_parser().parse_args([
+        ' ', '--backend=%s' % backend, '--no-daemon',
+        '--kb-filename=%s' % os.path.join(tmp_dir, 'kb', 'howdou.yml'),
+        '--kb-timestamp=%s' % os.path.join(tmp_dir, 'howdou_last'),
+        '--kb-app-dir=%s' % os.path.join(tmp_dir, 'app'),
+        '--kb-lockfile-path=%s' % os.path.join(tmp_dir, 'lock'),
+        '--cache-dir=%s' % os.path.join(tmp_dir, 'cache'),
+    ] + list(extra_args)))
+    hdu = HowDoU(**args)
+    if backend == howdou.ElasticsearchBackend.name:
+        hdu.search_backend._client = FakeElasticsearch() # pylint: disable=protected-access
+    return hdu
+
+def get_latencies(func, values):
+    latencies = []
+    for value in values:
+        t0 = time.time()
+        func(value)
+        latencies.append(time.time() - t0)
+    return OrderedDict([
+        ('count', len(latencies)),
+        ('p50', percentile(latencies, 50)),
+        ('p99', percentile(latencies, 99)),
+        ('mean', sum(latencies) / len(latencies) if latencies else 0),
+    ])
+
+@contextlib.contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+def benchmark_size(entries, backend=howdou.LocalBackend.name, queries=200, jobs=None):
+    """
+    Runs every in-process benchmark against a knowledge base of the given size, and returns the measurements.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        results = OrderedDict()
+        t0 = time.time()
+        _, questions = generate_kb(os.path.join(tmp_dir, 'kb'), entries)
+        questions = questions[:queries]
+        results['generate_seconds'] = time.time() - t0
+
+        extra_args = ['--jobs=%i' % jobs] if jobs else []
+        hdu = get_howdou(tmp_dir, backend, *extra_args)
+
+        # Parsing, both from scratch and from the parse cache.
+        for name in ('iter_kb_cold_seconds', 'iter_kb_warm_seconds'):
+            t0 = time.time()
+            with quiet():
+                for _ in hdu.iter_kb():
+                    pass
+            results[name] = time.time() - t0
+        shutil.rmtree(hdu.kb_parse_cache_dir)
+
+        # Reindexing everything, and then again once nothing has changed.
+        t0 = time.time()
+        with quiet():
+            hdu.index_kb()
+        td = time.time() - t0
+        results['index_kb_seconds'] = td
+        results['index_kb_docs_per_second'] = entries / td if td else 0
+        # Mark the knowledge base as changed, even on filesystems with coarse timestamps, without changing its content.
+        later = os.path.getmtime(hdu.kb_index_timestamp) + 1
+        os.utime(hdu.kb_filename, (later, later))
+        t0 = time.time()
+        with quiet():
+            hdu.index_kb()
+        results['index_kb_unchanged_seconds'] = time.time() - t0
+
+        # Querying, first computing each result and then reading it back from the query cache.
+        results['get_local_answers_cold'] = get_latencies(hdu.get_local_answers, questions)
+        results['get_local_answers_warm'] = get_latencies(hdu.get_local_answers, questions)
+
+        # Colorizing answers, the way -c does when they weren't rendered at index time.
+        hdu.color = True
+        texts = [item['answers'][0]['text'] for item, _ in zip(hdu.iter_kb(), range(queries))]
+        results['format_output'] = get_latencies(hdu.format_output, texts)
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def benchmark_remote(queries=20):
+    """
+    Measures answering queries online, against the stand-in web server and with the web cache disabled.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        hdu = get_howdou(tmp_dir, howdou.LocalBackend.name, '--ignore-local', '--disable-cache', '--num-answers=3')
+        with stand_in_web():
+            return get_latencies(
+                lambda q: hdu.run_query(q, output=False),
+                ['remote question %i' % i for i in range(queries)])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def run_command(command, _):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, '-m', 'howdou.howdou'] + command, stdout=devnull)
+
+def benchmark_startup(runs=5):
+    """
+    Measures how long the command line takes to start, both to print its version and to answer a local query.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        generate_kb(os.path.join(tmp_dir, 'kb'), 100)
+        hdu = get_howdou(tmp_dir, howdou.LocalBackend.name)
+        with quiet():
+            hdu.index_kb()
+        args = [
+            '--backend=local', '--no-daemon', '--ignore-remote',
+            '--kb-filename=%s' % hdu.kb_filename,
+            '--kb-timestamp=%s' % hdu.kb_timestamp,
+            '--kb-app-dir=%s' % hdu.kb_app_dir,
+            '--kb-lockfile-path=%s' % hdu.kb_lockfile_path,
+            '--cache-dir=%s' % hdu.cache_dir,
+        ]
+        results = OrderedDict()
+        for name, command in (('version', ['--version']), ('local_query', ['how', 'to', 'list', 'files'] + args)):
+            results[name] = get_latencies(functools.partial(run_command, command), range(runs))
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def get_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull
+            ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(sizes, backend=howdou.LocalBackend.name, queries=200, remote_queries=20, startup_runs=5, jobs=None):
+    """
+    Runs all benchmarks and returns the results as a dictionary, ready to be saved as JSON.
+    """
+    results = OrderedDict()
+    results['version'] = __version__
+    results['commit'] = get_commit()
+    results['python'] = platform.python_version()
+    results['platform'] = platform.platform()
+    results['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    results['backend'] = backend
+    results['sizes'] = OrderedDict()
+    for size in sizes:
+        print('Benchmarking %i entries...' % size, file=sys.stderr)
+        results['sizes'][str(size)] = benchmark_size(size, backend=backend, queries=queries, jobs=jobs)
+    if remote_queries:
+        print('Benchmarking remote queries...', file=sys.stderr)
+        results['remote_query'] = benchmark_remote(remote_queries)
+    if startup_runs:
+        print('Benchmarking startup...', file=sys.stderr)
+        results['startup'] = benchmark_startup(startup_runs)
+    return results
+
+def flatten(data, prefix=''):
+    """
+    Returns the numeric measurements in the nested results as a flat dictionary keyed by their dotted path.
+    """
+    flat = OrderedDict()
+    for key, value in data.items():
+        path = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+def compare(old, new):
+    """
+    Returns a line for each measurement in both results, showing its old and new values and the change.
+    """
+    old, new = flatten(old), flatten(new)
+    lines = []
+    for key, value in new.items():
+        if key.endswith('.count'):
+            continue
+        if key in old and old[key]:
+            lines.append('%-60s %12.6f %12.6f %+8.1f%%' % (key, old[key], value, (value - old[key]) / old[key] * 100))
+    return lines
+
+def get_benchmark_parser():
+    parser = argparse.ArgumentParser(description='benchmarks howdou against a synthetic knowledge base')
+    parser.add_argument(
+        '--sizes',
+        help='Comma-separated knowledge base sizes, in entries, to benchmark. Default is %s.' % DEFAULT_SIZES,
+        default=DEFAULT_SIZES)
+    parser.add_argument(
+        '--backend',
+        help='The search backend to benchmark. Elasticsearch is replaced by an in-memory stand-in. Default is local.',
+        default=howdou.LocalBackend.name,
+        choices=sorted(howdou.BACKENDS))
+    parser.add_argument(
+        '--queries',
+        help='The number of distinct local queries timed per size. Default is 200.',
+        default=200, type=int)
+    parser.add_argument(
+        '--remote-queries',
+        help='The number of queries answered by the stand-in web server. Default is 20.',
+        default=20, type=int)
+    parser.add_argument(
+        '--startup-runs',
+        help='The number of times the command line is started. Default is 5.',
+        default=5, type=int)
+    parser.add_argument(
+        '--jobs',
+        help='The number of processes used to parse included files. Default is the number of CPUs.',
+        default=None, type=int)
+    parser.add_argument(
+        '--output',
+        help='The file the results are written to, as JSON. Default is standard output.',
+        default=None)
+    parser.add_argument(
+        '--compare',
+        help='The results of an earlier run, as JSON, to show the change in each measurement against.',
+        default=None)
+    return parser
+
+def main():
+    args = get_benchmark_parser().parse_args()
+    sizes = [int(_) for _ in args.sizes.split(',') if _.strip()]
+    results = run_benchmarks(
+        sizes, backend=args.backend, queries=args.queries, remote_queries=args.remote_queries,
+        startup_runs=args.startup_runs, jobs=args.jobs)
+    data = json.dumps(results, indent=4)
+    if args.output:
+        with io.open(args.output, 'w', encoding='utf-8') as fout:
+            fout.write(data + '\n')
+    else:
+        print(data)
+    if args.compare:
+        with io.open(args.compare, encoding='utf-8') as fin:
+            for line in compare(json.load(fin), results):
+                print(line, file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -11,33 +11,37 @@ import os
 import re
 import sys
 import hashlib
+import io
+import json
+import math
+import pickle
+import shutil
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import zlib
 import traceback
 from pprint import pprint
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
 try:
     from commands import getoutput
 except ImportError:
     from subprocess import getoutput
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 #https://pythonhosted.org/six/
 from six import text_type, string_types
 
-import requests
-#from requests.exceptions import ConnectionError # pylint: disable=redefined-builtin
-from requests.exceptions import SSLError
-
-import yaml
-
-import dateutil.parser
-
-from fake_useragent import UserAgent
-
-from pygments import highlight
-from pygments.lexers import guess_lexer, get_lexer_by_name
-from pygments.formatters import TerminalFormatter # pylint: disable=no-name-in-module
-from pygments.util import ClassNotFound
-
-# import requests_cache
+# The heavier dependencies (requests, yaml, dateutil, fake_useragent, pygments, pyquery and elasticsearch)
+# are imported only by the code paths that need them, since simple local queries are run constantly
+# and their import time would otherwise outweigh the query itself.
 
 try:
     from urllib.parse import quote as url_quote
@@ -51,11 +55,6 @@ except ImportError:
 
 import fasteners
 
-from pyquery import PyQuery as pq
-
-from elasticsearch import Elasticsearch
-#from elasticsearch.exceptions import NotFoundError
-
 #from howdou import __version__
 from .__init__ import __version__
 
@@ -72,12 +71,52 @@ else:
 LOCAL = 'local'
 REMOTE = 'remote'
 
+TEXT = 'text'
+JSON = 'json'
+NDJSON = 'ndjson'
+FORMATS = (TEXT, JSON, NDJSON)
+OUTPUT_FORMAT = os.getenv('HOWDOU_FORMAT', TEXT)
+
 KNOWLEDGEBASE_FN = os.path.expanduser(os.getenv('HOWDOU_KB', '~/.howdou.yml'))
 KNOWLEDGEBASE_INDEX = os.getenv('HOWDOU_INDEX', 'howdou')
 KNOWLEDGEBASE_TIMESTAMP_FN = os.path.expanduser(os.getenv('HOWDOU_TIMESTAMP', '~/.howdou_last'))
 APP_DATA_DIR = os.path.expanduser(os.getenv('HOWDOU_DIR', '~/.howdou'))
 LOCKFILE_PATH = os.path.expanduser(os.getenv('HOWDOU_LOCKFILE', '~/.howdou_lock'))
+SOCKET_PATH = os.path.expanduser(os.getenv('HOWDOU_SOCKET', '~/.howdou.sock'))
+# A daemon that doesn't accept the connection this quickly is assumed stuck.
+DAEMON_CONNECT_TIMEOUT = 1
+# Unless given, the time a daemon has to answer is derived from the remote request timeouts.
+DAEMON_TIMEOUT = float(os.getenv('HOWDOU_DAEMON_TIMEOUT')) if os.getenv('HOWDOU_DAEMON_TIMEOUT') else None
+# Extra seconds a daemon is given to answer, on top of the time its remote requests may take.
+DAEMON_TIMEOUT_MARGIN = 5
 CACHE_DIR = os.path.join(os.path.join(os.path.expanduser('~'), '.cache'), 'howdou')
+CACHE_TTL = float(os.getenv('HOWDOU_CACHE_TTL', str(7 * 24 * 60 * 60)))
+CACHE_MAX_SIZE = float(os.getenv('HOWDOU_CACHE_MAX_SIZE', '50'))
+DISABLE_CACHE = bool(os.getenv('HOWDOU_DISABLE_CACHE'))
+DISABLE_QUERY_LOG = bool(os.getenv('HOWDOU_DISABLE_QUERY_LOG'))
+CONNECT_TIMEOUT = float(os.getenv('HOWDOU_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.getenv('HOWDOU_READ_TIMEOUT', '15'))
+RETRIES = int(os.getenv('HOWDOU_RETRIES', '2'))
+RETRY_BACKOFF_FACTOR = 0.5
+PRERENDER = bool(os.getenv('HOWDOU_PRERENDER'))
+QUERY_CACHE_ENTRIES = 256
+QUERY_CACHE_MAX_SIZE = 10 * 1024 * 1024
+# Cached local results are invalidated by reindexing, so they only expire to reclaim space.
+QUERY_CACHE_TTL = 30 * 24 * 60 * 60
+MAX_WORKERS = int(os.getenv('HOWDOU_MAX_WORKERS', '8'))
+
+DUMP_SITE = os.getenv('HOWDOU_DUMP_SITE', 'https://stackoverflow.com')
+
+# The number of dump rows staged, and of documents loaded, between checkpoints.
+DUMP_STAGE_BATCH_SIZE = 10000
+DUMP_CHECKPOINT_INTERVAL = 50000
+
+BATCH_WORKERS = int(os.getenv('HOWDOU_BATCH_WORKERS', '4'))
+WARM_LIMIT = int(os.getenv('HOWDOU_WARM_LIMIT', '100'))
+WARM_WORKERS = int(os.getenv('HOWDOU_WARM_WORKERS', '4'))
+DEFAULT_BACKEND = os.getenv('HOWDOU_BACKEND', 'elasticsearch')
+ES_HOSTS = os.getenv('HOWDOU_ES_HOSTS', '')
+ES_TIMEOUT = float(os.getenv('HOWDOU_ES_TIMEOUT', '10'))
 
 KNOWLEDGEBASE_STUB = '''-   questions:
     -   how do I create a new howdou knowledge base entry
@@ -114,11 +153,23 @@ REINDEX = 'reindex'
 CLEAR_CACHE = 'clear-cache'
 SUMMARIZE_FIELD = 'summarize-field'
 FILTER_BY_FIELD = 'filter-by-field'
-ACTIONS = (QUERY, REINDEX, CLEAR_CACHE, SUMMARIZE_FIELD, FILTER_BY_FIELD)
+IMPORT_DUMP = 'import-dump'
+WARM = 'warm'
+ACTIONS = (QUERY, REINDEX, CLEAR_CACHE, SUMMARIZE_FIELD, FILTER_BY_FIELD, IMPORT_DUMP, WARM)
 
 DEFAULT_USERAGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:51.0) Gecko/20100101 Firefox/51.0'
 
-ua = UserAgent(fallback=DEFAULT_USERAGENT)
+_user_agent = None
+
+def get_user_agent():
+    """
+    Returns the fake user agent generator, which is created on first use since it may need to load a data file.
+    """
+    global _user_agent # pylint: disable=global-statement
+    if _user_agent is None:
+        from fake_useragent import UserAgent
+        _user_agent = UserAgent(fallback=DEFAULT_USERAGENT)
+    return _user_agent
 
 # Force dictionaries to be serialized in multi-line format.
 def _represent_dictorder(self, data):
@@ -143,13 +194,24 @@ def _represent_dictorder(self, data):
 def _selective_representer(dumper, data):
     return dumper.represent_scalar(u"tag:yaml.org,2002:str", data, style="|" if "\n" in data else None)
 
-yaml.add_representer(str, _selective_representer)
-yaml.add_representer(text_type, _selective_representer)
-yaml.add_representer(dict, _represent_dictorder)
-# yaml.add_representer(_AliasDict, _represent_dictorder)
-#yaml.add_representer(tuple, _represent_tuple) # we need tuples for hash keys
-# yaml.add_constructor(u'tag:yaml.org,2002:python/tuple', _construct_tuple)
-# yaml.add_representer(types.FunctionType, _represent_function)
+_yaml = None
+
+def get_yaml():
+    """
+    Imports and returns the yaml module, registering our custom representers on first use.
+    """
+    global _yaml # pylint: disable=global-statement
+    if _yaml is None:
+        import yaml
+        yaml.add_representer(str, _selective_representer)
+        yaml.add_representer(text_type, _selective_representer)
+        yaml.add_representer(dict, _represent_dictorder)
+        # yaml.add_representer(_AliasDict, _represent_dictorder)
+        #yaml.add_representer(tuple, _represent_tuple) # we need tuples for hash keys
+        # yaml.add_constructor(u'tag:yaml.org,2002:python/tuple', _construct_tuple)
+        # yaml.add_representer(types.FunctionType, _represent_function)
+        _yaml = yaml
+    return _yaml
 
 def get_nested_key(element, keys):
     """
@@ -178,6 +240,128 @@ def get_link_at_pos(links, position):
         link = links[-1]
     return link
 
+_lexers = {}
+
+def get_lexer(name):
+    """
+    Returns the Pygments lexer for the given name, or None if there isn't one.
+
+    Lookups, including misses, are cached, since most keywords we try aren't language names.
+    """
+    name = name.lower()
+    if name not in _lexers:
+        from pygments.lexers import get_lexer_by_name
+        from pygments.util import ClassNotFound
+        try:
+            _lexers[name] = get_lexer_by_name(name)
+        except ClassNotFound:
+            _lexers[name] = None
+    return _lexers[name]
+
+def highlight_code(code, keywords=()):
+    """
+    Returns the code colorized for the terminal, using the lexer of the first keyword naming a language.
+    """
+    from pygments import highlight
+    from pygments.formatters import TerminalFormatter # pylint: disable=no-name-in-module
+    lexer = None
+    for keyword in keywords:
+        lexer = get_lexer(keyword)
+        if lexer:
+            break
+
+    # no lexer found above, use the guesser
+    if not lexer:
+        from pygments.lexers import guess_lexer
+        lexer = guess_lexer(code)
+
+    return highlight(code, lexer, TerminalFormatter(bg='dark'))
+
+# Bump this whenever extract_answer changes, so records extracted by older versions aren't reused.
+EXTRACT_VERSION = 1
+
+EXTRACT_CHUNK_SIZE = 16 * 1024
+
+def has_class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+_answer_xpaths = {}
+
+def get_answer_xpaths():
+    """
+    Returns the XPath expressions used to extract an answer, compiled once.
+    """
+    if not _answer_xpaths:
+        from lxml import etree
+        _answer_xpaths.update(
+            pre=etree.XPath('.//pre'),
+            code=etree.XPath('.//code'),
+            post_text=etree.XPath('.//*[%s]' % has_class('post-text')),
+            blocks=etree.XPath('.//*[%s]/*' % has_class('post-text')),
+        )
+    return _answer_xpaths
+
+def iter_closed_elements(page):
+    """
+    Parses the HTML page a chunk at a time, yielding each element as soon as its closing tag is read,
+    so parsing stops wherever the caller stops iterating.
+    """
+    from lxml import etree
+    parser = etree.HTMLPullParser(events=('end',))
+    for i in range(0, len(page), EXTRACT_CHUNK_SIZE):
+        parser.feed(page[i:i + EXTRACT_CHUNK_SIZE])
+        for _, element in parser.read_events():
+            yield element
+    parser.close()
+    for _, element in parser.read_events():
+        yield element
+
+def extract_answer(page):
+    """
+    Extracts everything needed to show an answer from a question page, as a small JSON-compatible record:
+    the question's tags, and the first answer's first code block, text and top-level blocks of text.
+
+    Only the page up to the end of the first answer is parsed.
+    """
+    from pyquery import PyQuery as pq
+    tags = []
+    answer = None
+    for element in iter_closed_elements(page or ''):
+        classes = (element.get('class') or '').split()
+        if 'post-tag' in classes:
+            tags.append(element.text)
+        elif 'answer' in classes:
+            answer = element
+            break
+
+    record = dict(tags=tags, code=None, post_text='', blocks=[])
+    if answer is not None:
+        xpaths = get_answer_xpaths()
+        instructions = xpaths['pre'](answer) or xpaths['code'](answer)
+        if instructions:
+            record['code'] = pq(instructions[0]).text()
+        post_text = xpaths['post_text'](answer)
+        if post_text:
+            record['post_text'] = pq(post_text[0]).text()
+        record['blocks'] = [(block.tag, pq(block).text()) for block in xpaths['blocks'](answer)]
+    return record
+
+def get_question_links(links):
+    """
+    Returns the distinct links to questions, in their original order.
+    """
+    question_links = []
+    seen = set()
+    for link in links:
+        if not re.search(r'questions/\d+/', link):
+            continue
+        true_link = find_true_link(link)
+        if true_link in seen:
+            continue
+        seen.add(true_link)
+        question_links.append(link)
+    return question_links
+
 def touch(fname, times=None):
     with open(fname, 'a'):
         os.utime(fname, times)
@@ -192,120 +376,1610 @@ def get_text_hash(text):
     h.update(text.encode('utf-8', 'replace'))
     return h.hexdigest()
 
-def get_proxies():
-    proxies = getproxies()
-    filtered_proxies = {}
-    for key, value in proxies.items():
-        if key.startswith('http'):
-            if not value.startswith('http'):
-                filtered_proxies[key] = 'http://%s' % value
-            else:
-                filtered_proxies[key] = value
-    return filtered_proxies
+def get_proxies():
+    proxies = getproxies()
+    filtered_proxies = {}
+    for key, value in proxies.items():
+        if key.startswith('http'):
+            if not value.startswith('http'):
+                filtered_proxies[key] = 'http://%s' % value
+            else:
+                filtered_proxies[key] = value
+    return filtered_proxies
+
+def find_true_link(s):
+    """
+    Sometimes Google wraps our links inside sneaky tracking links, which often fail and slow us down
+    so remove them.
+    """
+    # Convert "/url?q=<real_url>" to "<real_url>".
+    if s and s.startswith('/') and 'http' in s:
+        s = s[s.find('http'):]
+    return s
+
+WORD_PATTERN = re.compile(r'\w+', re.U)
+
+def tokenize(text):
+    """
+    Splits text into lowercase word tokens, roughly matching Elasticsearch's standard analyzer.
+    """
+    return WORD_PATTERN.findall((text or '').lower())
+
+# The only fields needed to display local answers.
+SOURCE_FIELDS = ['questions', 'answer', 'source', 'filename', 'weight', 'formatter']
+
+class SearchBackend():
+    """
+    The interface every search engine used for the local knowledge base must implement.
+    """
+
+    name = None
+
+    def __init__(self, howdou):
+        self.howdou = howdou
+
+    @property
+    def index_name(self):
+        return self.howdou.kb_index_name
+
+    def delete_index(self):
+        raise NotImplementedError
+
+    def ensure_index(self):
+        raise NotImplementedError
+
+    def index(self, doc_id, doc):
+        raise NotImplementedError
+
+    def update(self, doc_id, partial_doc):
+        raise NotImplementedError
+
+    def delete(self, doc_id):
+        raise NotImplementedError
+
+    def bulk(self, actions, batch_size=500, concurrency=1):
+        """
+        Applies a stream of actions, each a dict with the keys `_op_type`, `_id` and `_source`,
+        in the format used by the Elasticsearch bulk helpers.
+        Index actions replace the whole document, update actions merge in `_source['doc']`,
+        and delete actions remove the document.
+
+        Yields a tuple of (ok, op_type, doc_id, error) for each action.
+        """
+        for action in actions:
+            op_type = action.get('_op_type', 'index')
+            try:
+                if op_type == 'index':
+                    self.index(action['_id'], action['_source'])
+                elif op_type == 'update':
+                    self.update(action['_id'], action['_source']['doc'])
+                elif op_type == 'delete':
+                    self.delete(action['_id'])
+                else:
+                    raise ValueError('Unsupported bulk operation: %s' % op_type)
+            except Exception as e: # pylint: disable=broad-except
+                yield False, op_type, action['_id'], e
+            else:
+                yield True, op_type, action['_id'], None
+
+    def refresh(self):
+        raise NotImplementedError
+
+    def search(self, query, size=10, fields=None):
+        """
+        Returns up to size hits, in the same shape as Elasticsearch search hits,
+        ordered by their score multiplied by their weight.
+
+        Hits matching every query term are preferred. Only if there are none are hits matching any term returned.
+        Each hit's `_source` only needs to contain the given fields, which default to SOURCE_FIELDS.
+        """
+        raise NotImplementedError
+
+class ElasticsearchBackend(SearchBackend):
+    """
+    Stores the knowledge base in an Elasticsearch server.
+
+    A single client, and its pool of keep-alive connections, is shared by every call made through this backend.
+    """
+
+    name = 'elasticsearch'
+
+    def __init__(self, *args, **kwargs):
+        super(ElasticsearchBackend, self).__init__(*args, **kwargs)
+        self._client = None
+        self._index_exists = False
+
+    @property
+    def client(self):
+        if self._client is None:
+            hosts = [_.strip() for _ in (self.howdou.es_hosts or '').split(',') if _.strip()] or None
+            from elasticsearch import Elasticsearch
+            self._client = Elasticsearch(
+                hosts,
+                timeout=self.howdou.es_timeout,
+                # Size the connection pool so parallel bulk requests don't have to open throwaway connections.
+                maxsize=max(10, self.howdou.index_concurrency),
+            )
+        return self._client
+
+    def delete_index(self):
+        self.client.indices.delete(index=self.index_name, ignore=[400, 404])
+        self._index_exists = False
+
+    def ensure_index(self):
+        if not self._index_exists:
+            self.client.indices.create(index=self.index_name, ignore=400)
+            self._index_exists = True
+
+    def index(self, doc_id, doc):
+        # https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.Elasticsearch.index
+        self.client.index(
+            id=doc_id,
+            index=self.index_name,
+            doc_type='text',
+            body=doc,
+        )
+        self._index_exists = True
+
+    def update(self, doc_id, partial_doc):
+        self.client.update(id=doc_id, index=self.index_name, doc_type='text', body={'doc': partial_doc})
+
+    def delete(self, doc_id):
+        self.client.delete(id=doc_id, index=self.index_name, doc_type='text', ignore=404)
+
+    def bulk(self, actions, batch_size=500, concurrency=1):
+        # https://elasticsearch-py.readthedocs.io/en/master/helpers.html
+        from elasticsearch.helpers import streaming_bulk, parallel_bulk
+
+        def _iter_actions():
+            for action in actions:
+                action = dict(action, _index=self.index_name, _type='text')
+                yield action
+
+        kwargs = dict(chunk_size=batch_size, raise_on_error=False, raise_on_exception=False)
+        if concurrency > 1:
+            results = parallel_bulk(self.client, _iter_actions(), thread_count=concurrency, **kwargs)
+        else:
+            results = streaming_bulk(self.client, _iter_actions(), **kwargs)
+        for ok, result in results:
+            op_type, info = list(result.items())[0]
+            if op_type == 'delete' and info.get('status') == 404:
+                # The document is already gone, which is all we wanted.
+                ok = True
+            yield ok, op_type, info.get('_id'), info.get('error')
+        self._index_exists = True
+
+    def refresh(self):
+        self.client.indices.refresh(index=self.index_name)
+
+    def get_query(self, query, size, exact, fields):
+        # https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-query-string-query.html
+        # https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-function-score-query.html#CO158-1
+        # Order searches by a mix of how closely they match the query string
+        # along with the custom weight.
+        return {
+            "size": size,
+            "_source": fields,
+            "query": {
+                "function_score": {
+                    "boost": '5' if exact else '1',
+                    'query': {
+                        'query_string':{
+                            'query': query,
+                            'fields': ['questions'],
+                            'default_operator': 'AND' if exact else 'OR',
+                        },
+                    },
+                    "functions": [{
+                        "script_score": {
+                            "script" : {
+                              "lang": "painless",
+                              "inline": "_score * doc['weight'].value"
+                            },
+                        },
+                    }],
+                }
+            }
+        }
+
+    def search(self, query, size=10, fields=None):
+        # Send the exact and fuzzy searches together, so a miss on the exact search doesn't cost another round trip.
+        # https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.Elasticsearch.msearch
+        body = []
+        for exact in (True, False):
+            body.append({'index': self.index_name})
+            body.append(self.get_query(query, size, exact, fields or SOURCE_FIELDS))
+
+        if self.howdou.verbose:
+            print('es_query:')
+            pprint(body, indent=4)
+
+        # The index is only created once a search finds it missing,
+        # rather than checked on every new instance, which would cost each command line query a round trip.
+        responses = self.client.msearch(body=body)['responses']
+        if any(response.get('status') == 404 for response in responses):
+            self._index_exists = False
+            self.ensure_index()
+            responses = self.client.msearch(body=body)['responses']
+        for response in responses:
+            if 'error' in response:
+                raise Exception('Search failed: %s' % (response['error'],))
+
+        if self.howdou.verbose:
+            print('results:')
+            pprint(responses, indent=4)
+
+        # First try finding an entry with all the keywords using the AND operator.
+        # If nothing found, then fall back to entries with any of the keywords using the OR operator.
+        exact_response, fuzzy_response = responses
+        return exact_response['hits']['hits'] or fuzzy_response['hits']['hits']
+
+class LocalBackend(SearchBackend):
+    """
+    A pure-Python BM25 inverted index over the questions field, pickled to the app directory.
+
+    Needs no server, so it's a light alternative to Elasticsearch for knowledge bases of a few thousand entries.
+    """
+
+    name = 'local'
+
+    # Same defaults as Lucene's BM25Similarity.
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, *args, **kwargs):
+        super(LocalBackend, self).__init__(*args, **kwargs)
+        self._data = None
+        self._mtime = None
+
+    @property
+    def index_filename(self):
+        return os.path.join(self.howdou.kb_index_dir, '%s.index' % self.index_name)
+
+    def get_mtime(self):
+        try:
+            return os.path.getmtime(self.index_filename)
+        except OSError:
+            return None
+
+    @property
+    def data(self):
+        # Pick up changes saved by another process, which matters when we're kept alive by the daemon.
+        mtime = self.get_mtime()
+        if self._data is None or mtime != self._mtime:
+            self._data = self.load()
+            self._mtime = mtime
+        return self._data
+
+    def load(self):
+        if os.path.isfile(self.index_filename):
+            with open(self.index_filename, 'rb') as fin:
+                return pickle.load(fin)
+        return self.empty()
+
+    def empty(self):
+        return dict(
+            # {doc_id: doc}
+            docs={},
+            # {doc_id: number of question tokens}
+            lengths={},
+            # {term: {doc_id: term frequency}}
+            postings={},
+        )
+
+    def delete_index(self):
+        if os.path.isfile(self.index_filename):
+            os.remove(self.index_filename)
+        self._data = self.empty()
+        self._mtime = None
+
+    def ensure_index(self):
+        self.data # pylint: disable=pointless-statement
+
+    def unindex(self, doc_id):
+        data = self.data
+        if doc_id not in data['docs']:
+            return
+        for term in set(tokenize(data['docs'].pop(doc_id)['questions'])):
+            postings = data['postings'].get(term)
+            if postings:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del data['postings'][term]
+        del data['lengths'][doc_id]
+
+    def index(self, doc_id, doc):
+        self.unindex(doc_id)
+        data = self.data
+        tokens = tokenize(doc['questions'])
+        data['docs'][doc_id] = doc
+        data['lengths'][doc_id] = len(tokens)
+        for term in tokens:
+            postings = data['postings'].setdefault(term, {})
+            postings[doc_id] = postings.get(doc_id, 0) + 1
+
+    def update(self, doc_id, partial_doc):
+        doc = dict(self.data['docs'][doc_id])
+        doc.update(partial_doc)
+        self.index(doc_id, doc)
+
+    def delete(self, doc_id):
+        self.unindex(doc_id)
+
+    def refresh(self):
+        if not os.path.isdir(self.howdou.kb_index_dir):
+            os.makedirs(self.howdou.kb_index_dir)
+        # Write to a temporary file first so concurrent readers never see a partial index.
+        tmp_filename = self.index_filename + '.tmp'
+        with open(tmp_filename, 'wb') as fout:
+            pickle.dump(self.data, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, self.index_filename)
+        self._mtime = self.get_mtime()
+
+    def search(self, query, size=10, fields=None):
+        for exact in (True, False):
+            hits = self.search_terms(query, exact)
+            if hits:
+                return hits[:size]
+        return []
+
+    def search_terms(self, query, exact=True):
+        data = self.data
+        terms = sorted(set(tokenize(query)))
+        total_docs = len(data['docs'])
+        hits = []
+        if terms and total_docs:
+            avg_length = sum(data['lengths'].values()) / float(total_docs)
+            postings = [data['postings'].get(term, {}) for term in terms]
+            if exact:
+                # Mimic the AND operator by only considering documents containing every term.
+                candidates = set(data['docs'])
+                for term_postings in postings:
+                    candidates.intersection_update(term_postings)
+            else:
+                candidates = set()
+                for term_postings in postings:
+                    candidates.update(term_postings)
+            boost = 5 if exact else 1
+            for doc_id in candidates:
+                score = 0.
+                norm = self.k1 * (1 - self.b + self.b * data['lengths'][doc_id] / avg_length)
+                for term_postings in postings:
+                    tf = term_postings.get(doc_id)
+                    if not tf:
+                        continue
+                    idf = math.log(1 + (total_docs - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+                    score += idf * tf * (self.k1 + 1) / (tf + norm)
+                doc = data['docs'][doc_id]
+                hits.append({
+                    '_id': doc_id,
+                    '_score': score * boost * doc['weight'],
+                    '_source': doc,
+                })
+            hits.sort(key=lambda hit: (-hit['_score'], hit['_id']))
+        return hits
+
+BACKENDS = dict((_cls.name, _cls) for _cls in (ElasticsearchBackend, LocalBackend))
+
+class DumpStaging():
+    """
+    A SQLite database holding the questions, and the top-voted answer to each, read from a Stack Exchange dump,
+    along with checkpoints recording how far the import got, so an interrupted import can pick up where it left off.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        # The staging database can always be rebuilt from the dump, so trade durability for speed.
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY, title TEXT, tags TEXT)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS answers ('
+                'parent_id INTEGER PRIMARY KEY, id INTEGER, score INTEGER, body TEXT, created TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+
+    def get_meta(self, key, default=None):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def add(self, questions, answers, rows):
+        """
+        Stores the given questions, and answers that score higher than any already stored for their question,
+        and records that the first rows of the dump have been staged, all in one transaction.
+        """
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO questions VALUES (?, ?, ?)', questions)
+            self.connection.executemany('INSERT OR IGNORE INTO answers VALUES (?, ?, ?, ?, ?)', answers)
+            self.connection.executemany(
+                'UPDATE answers SET id = ?, score = ?, body = ?, created = ? WHERE parent_id = ? AND score < ?',
+                [(_id, score, body, created, parent_id, score) for parent_id, _id, score, body, created in answers])
+            self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('rows', rows))
+
+    def get_pairs(self, after_id, limit):
+        """
+        Returns up to limit questions, with their top-voted answer, in order of question id, after the given one.
+        """
+        return self.connection.execute(
+            'SELECT q.id, q.title, q.tags, a.score, a.body, a.created FROM questions q '
+            'JOIN answers a ON a.parent_id = q.id WHERE q.id > ? ORDER BY q.id LIMIT ?', (after_id, limit)).fetchall()
+
+    def count_pairs(self):
+        return self.connection.execute('SELECT COUNT(*) FROM questions q JOIN answers a ON a.parent_id = q.id').fetchone()[0]
+
+    def delete(self):
+        self.connection.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.isfile(self.filename + suffix):
+                os.remove(self.filename + suffix)
+
+class IndexManifest():
+    """
+    Records every document sent to the search backend, along with a hash of its content,
+    in a single SQLite database, so reindexing only needs to send what changed since the last run.
+    """
+
+    # Older versions stored one file per question, named after the question's hash and containing the answer's hash.
+    LEGACY_PATTERN = re.compile(r'^[0-9a-f]{128}$')
+
+    def __init__(self, app_dir, legacy_dir=None):
+        self.app_dir = app_dir
+        # The directory older versions wrote their per-question files to, if they may have been written for this index.
+        self.legacy_dir = legacy_dir
+        self.filename = os.path.join(app_dir, 'manifest.sqlite3')
+        self._connection = None
+        self._file_id = None
+        # Queries read the index generation from several threads in batch and daemon modes.
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self):
+        with self._lock:
+            if self._connection is None:
+                self._connect()
+        return self._connection
+
+    def _connect(self):
+        if self._connection is None:
+            if not os.path.isdir(self.app_dir):
+                os.makedirs(self.app_dir)
+            self._connection = sqlite3.connect(self.filename, check_same_thread=False)
+            with self._connection:
+                # Rows migrated from older formats have no doc_id or content_hash, only the question and answer hashes.
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS documents ('
+                    'doc_id TEXT UNIQUE, question_hash TEXT NOT NULL, answer_hash TEXT NOT NULL, '
+                    'content_hash TEXT, doc TEXT)')
+                self._connection.execute(
+                    'CREATE INDEX IF NOT EXISTS documents_pair ON documents (question_hash, answer_hash)')
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+                # The content hash of each knowledge base file as of the last reindex, so unchanged files can be skipped.
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, content_hash TEXT NOT NULL, answers INTEGER)')
+                # Older manifests don't record which file each document came from, or a hash of its source entry.
+                columns = set(row[1] for row in self._connection.execute('PRAGMA table_info(documents)'))
+                for column in ('filename', 'source_hash'):
+                    if column not in columns:
+                        self._connection.execute('ALTER TABLE documents ADD COLUMN %s TEXT' % column)
+            self.migrate()
+            self._file_id = self.get_file_id()
+        return self._connection
+
+    def get_file_id(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return stat.st_dev, stat.st_ino, stat.st_mtime
+
+    def reopen_if_changed(self):
+        """
+        Closes the connection if the database has been written, deleted or replaced since it was opened,
+        such as by a reindex in another process, so the next access reads the current one.
+
+        Returns true if it was closed.
+        """
+        with self._lock:
+            if self._connection is None or self.get_file_id() == self._file_id:
+                return False
+            self.close()
+            return True
+
+    def migrate(self):
+        """
+        Imports and removes any records left by older manifest formats.
+        """
+        rows = []
+        legacy_fns = self.get_legacy_filenames()
+        for fn in legacy_fns:
+            with open(fn) as fin:
+                rows.append((os.path.basename(fn), fin.read().strip()))
+        legacy_table = self._connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'indexed'").fetchone()
+        if legacy_table:
+            rows.extend(self._connection.execute('SELECT question_hash, answer_hash FROM indexed'))
+        if not rows:
+            return
+        with self._connection:
+            self._connection.executemany(
+                'INSERT INTO documents (question_hash, answer_hash) VALUES (?, ?)', rows)
+            if legacy_table:
+                self._connection.execute('DROP TABLE indexed')
+        self.delete_legacy_files(legacy_fns)
+
+    def get_legacy_filenames(self):
+        if not self.legacy_dir or not os.path.isdir(self.legacy_dir):
+            return []
+        return [os.path.join(self.legacy_dir, fn) for fn in os.listdir(self.legacy_dir) if self.LEGACY_PATTERN.match(fn)]
+
+    def delete_legacy_files(self, filenames=None):
+        if filenames is None:
+            filenames = self.get_legacy_filenames()
+        for fn in filenames:
+            os.remove(fn)
+
+    def get_key(self, question_str, answer_str):
+        return get_text_hash(question_str), get_text_hash(answer_str)
+
+    def contains_many(self, pairs):
+        """
+        Given a list of (question, answer) tuples, returns the set of those that have been indexed.
+        """
+        keys = dict((self.get_key(*pair), pair) for pair in pairs)
+        found = set()
+        key_list = list(keys)
+        # Stay well under SQLite's default limit of 999 bound parameters per statement.
+        step = 400
+        for i in range(0, len(key_list), step):
+            chunk = key_list[i:i+step]
+            sql = 'SELECT question_hash, answer_hash FROM documents WHERE %s' \
+                % ' OR '.join(['(question_hash = ? AND answer_hash = ?)'] * len(chunk))
+            params = [value for key in chunk for value in key]
+            for row in self.connection.execute(sql, params):
+                found.add(keys[tuple(row)])
+        return found
+
+    def add_many(self, pairs):
+        pairs = list(pairs)
+        # Look up every pair in one batch, rather than one query per pair.
+        existing = self.contains_many(pairs)
+        keys = OrderedDict((self.get_key(*pair), None) for pair in pairs if pair not in existing)
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO documents (question_hash, answer_hash) VALUES (?, ?)', list(keys))
+
+    def get_many(self, doc_ids):
+        """
+        Returns a dictionary of {doc_id: (content_hash, doc)} for the given document ids that have been indexed.
+        """
+        found = {}
+        doc_ids = list(doc_ids)
+        step = 400
+        for i in range(0, len(doc_ids), step):
+            chunk = doc_ids[i:i+step]
+            sql = 'SELECT doc_id, content_hash, doc FROM documents WHERE doc_id IN (%s)' % ', '.join(['?'] * len(chunk))
+            for doc_id, content_hash, doc in self.connection.execute(sql, chunk):
+                found[doc_id] = (content_hash, json.loads(doc))
+        return found
+
+    def get_source_hashes(self, doc_ids):
+        """
+        Returns a dictionary of {doc_id: source_hash} for the given document ids that have been indexed.
+        """
+        found = {}
+        doc_ids = list(doc_ids)
+        step = 400
+        for i in range(0, len(doc_ids), step):
+            chunk = doc_ids[i:i+step]
+            sql = 'SELECT doc_id, source_hash FROM documents WHERE doc_id IN (%s)' % ', '.join(['?'] * len(chunk))
+            found.update(self.connection.execute(sql, chunk))
+        return found
+
+    def iter_doc_ids(self):
+        for (doc_id,) in self.connection.execute('SELECT doc_id FROM documents WHERE doc_id IS NOT NULL'):
+            yield doc_id
+
+    def iter_doc_filenames(self):
+        """
+        Yields a (doc_id, filename) tuple for every indexed document.
+        """
+        for row in self.connection.execute('SELECT doc_id, filename FROM documents WHERE doc_id IS NOT NULL'):
+            yield row
+
+    def save_many(self, rows):
+        """
+        Records documents as indexed, given a list of
+        (doc_id, question, answer, content_hash, doc, filename, source_hash) tuples.
+        """
+        if not rows:
+            return
+        with self.connection:
+            for doc_id, question_str, answer_str, content_hash, doc, filename, source_hash in rows:
+                question_hash, answer_hash = self.get_key(question_str, answer_str)
+                # Replace any record migrated from an older format.
+                self.connection.execute(
+                    'DELETE FROM documents WHERE doc_id IS NULL AND question_hash = ? AND answer_hash = ?',
+                    (question_hash, answer_hash))
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO documents '
+                    '(doc_id, question_hash, answer_hash, content_hash, doc, filename, source_hash) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (doc_id, question_hash, answer_hash, content_hash, json.dumps(doc, sort_keys=True), filename, source_hash))
+
+    def set_source_hashes(self, pairs):
+        """
+        Records new source hashes, given a list of (doc_id, source_hash) tuples, for documents that are otherwise unchanged.
+        """
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE documents SET source_hash = ? WHERE doc_id = ?', [(source_hash, doc_id) for doc_id, source_hash in pairs])
+
+    def get_files(self):
+        """
+        Returns a dictionary of {filename: (content_hash, answers)} for the knowledge base files read by the last reindex.
+        """
+        return dict((fn, (content_hash, answers)) for fn, content_hash, answers
+                    in self.connection.execute('SELECT filename, content_hash, answers FROM files'))
+
+    def save_files(self, files):
+        """
+        Records the knowledge base files read, given a dictionary of {filename: (content_hash, answers)},
+        where a value of None forgets the file.
+        """
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM files WHERE filename = ?', [(fn,) for fn, value in files.items() if value is None])
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                [(fn,) + tuple(value) for fn, value in files.items() if value is not None])
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def delete_many(self, doc_ids):
+        with self.connection:
+            self.connection.executemany('DELETE FROM documents WHERE doc_id = ?', [(doc_id,) for doc_id in doc_ids])
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+class Answer():
+    """
+    A single answer to a query, found either in the local index or online.
+
+    Fields can also be read by key, like the dictionaries older versions returned, e.g. answer['answer'].
+    """
+
+    __slots__ = ('answer', 'score', 'weight', 'location', 'source', 'filename', 'text', 'seconds')
+
+    def __init__(self, answer, score=1.0, weight=1.0, location=LOCAL, source=None, filename=None, text=None, seconds=None):
+        self.answer = answer
+        self.score = score
+        self.weight = weight
+        self.location = location
+        self.source = source
+        self.filename = filename
+        self.text = text
+        # The number of seconds from the start of the query until this answer was ready.
+        self.seconds = seconds
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def as_dict(self):
+        return OrderedDict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __eq__(self, other):
+        # The timing differs between runs of the same query, so it isn't part of the comparison.
+        if isinstance(other, Answer):
+            other = other.as_dict()
+        if not isinstance(other, dict):
+            return NotImplemented
+        return all(getattr(self, name) == other.get(name) for name in self.__slots__ if name != 'seconds')
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Answer(%s)' % ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__)
+
+class Profiler():
+    """
+    Records how long each named phase of a run takes, and counts events like bytes fetched,
+    for the --profile report.
+
+    Spans with the same name are added together, and may be recorded from several threads at once.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.spans = OrderedDict()
+        self.counters = OrderedDict()
+        self.t0 = time.time()
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, time.time() - t0)
+
+    def add_span(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            count, total, longest = self.spans.get(name, (0, 0, 0))
+            self.spans[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    def iterate(self, name, iterable):
+        """
+        Iterates over the iterable, recording the time spent producing its items, but not using them, as one span.
+        """
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iterable)
+
+    def _iterate(self, name, iterable):
+        total = 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                t0 = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    total += time.time() - t0
+                yield item
+        finally:
+            self.add_span(name, total)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """
+        Returns the spans, slowest first, and counters recorded since the last reset.
+        """
+        with self._lock:
+            spans = sorted(self.spans.items(), key=lambda o: -o[1][1])
+            return OrderedDict([
+                ('wall_seconds', time.time() - self.t0),
+                ('spans', OrderedDict((name, OrderedDict([
+                    ('count', count),
+                    ('total_seconds', total),
+                    ('mean_seconds', total / count),
+                    ('max_seconds', longest),
+                ])) for name, (count, total, longest) in spans)),
+                ('counters', OrderedDict(self.counters)),
+            ])
+
+class ProcessLock():
+    """
+    A reader-writer lock shared by every thread in the process, backed by one inter-process lock on a file.
+
+    The file lock is a POSIX record lock, which belongs to the whole process and is dropped as soon as
+    any handle to the file is closed, so threads mustn't each lock the file themselves. Instead the
+    file is read-locked by the first reader and unlocked by the last.
+    A thread holding the exclusive lock may take either lock again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = fasteners.InterProcessReaderWriterLock(path)
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+
+    def acquire_read(self):
+        with self._condition:
+            if self._writer is threading.current_thread():
+                self._depth += 1
+                return
+            while self._writer is not None:
+                self._condition.wait()
+            if not self._readers:
+                # Other threads wait for this, since they'd need the same lock anyway.
+                self._lock.acquire_read_lock()
+            self._readers += 1
+
+    def release_read(self):
+        with self._condition:
+            if self._writer is threading.current_thread():
+                self._depth -= 1
+                return
+            self._readers -= 1
+            if not self._readers:
+                self._lock.release_read_lock()
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        with self._condition:
+            if self._writer is threading.current_thread():
+                self._depth += 1
+                return
+            while self._writer is not None or self._readers:
+                self._condition.wait()
+            self._writer = threading.current_thread()
+        try:
+            self._lock.acquire_write_lock()
+        except BaseException:
+            with self._condition:
+                self._writer = None
+                self._condition.notify_all()
+            raise
+
+    def release_write(self):
+        with self._condition:
+            if self._depth:
+                self._depth -= 1
+                return
+            self._lock.release_write_lock()
+            self._writer = None
+            self._condition.notify_all()
+
+    @contextmanager
+    def read_lock(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_lock(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+_process_locks = {}
+_process_locks_lock = threading.Lock()
+
+def get_process_lock(path):
+    """
+    Returns the process-wide lock for the given lock file.
+    """
+    path = os.path.abspath(path)
+    with _process_locks_lock:
+        if path not in _process_locks:
+            _process_locks[path] = ProcessLock(path)
+        return _process_locks[path]
+
+class MemoryCache():
+    """
+    A thread-safe, in-memory, least-recently-used cache holding a fixed number of entries.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class ResponseCache():
+    """
+    A size-capped, least-recently-used cache of compressed text values in a single SQLite database,
+    where every entry expires after its own time-to-live.
+    """
+
+    def __init__(self, filename, max_size, ttl):
+        self.filename = filename
+        self.max_size = max_size
+        self.ttl = ttl
+        self._connection = None
+        # Remote answers are fetched from several threads at once, so serialize access to the shared connection.
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            cache_dir = os.path.dirname(self.filename)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            self._connection = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+            with self._connection:
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS responses ('
+                    'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, '
+                    'expires REAL NOT NULL, accessed REAL NOT NULL)')
+                self._connection.execute(
+                    'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        return self._connection
+
+    def get(self, key, min_ttl=0):
+        """
+        Returns the cached value for the key, or None if it's missing or expired.
+
+        If min_ttl is given, values expiring within that many seconds are treated as missing, but kept.
+        """
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute('SELECT value, expires FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return
+            with self.connection:
+                if row[1] < now:
+                    self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    return
+                if row[1] < now + min_ttl:
+                    return
+                self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        data = zlib.compress(value.encode('utf-8'))
+        with self._lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                (key, sqlite3.Binary(data), len(data), now + ttl, now))
+            self.evict(now)
+
+    def evict(self, now=None):
+        """
+        Removes expired entries, then the least recently used entries until the cache fits in its maximum size.
+        """
+        self.connection.execute('DELETE FROM responses WHERE expires < ?', (now or time.time(),))
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_size:
+            return
+        for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall():
+            self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def clear(self):
+        with self._lock, self.connection:
+            self.connection.execute('DELETE FROM responses')
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+class QueryLog():
+    """
+    Counts how often each question has been searched for online, so the most frequent can be fetched ahead of time.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._connection = None
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            log_dir = os.path.dirname(self.filename)
+            if log_dir and not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+            self._connection = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+            with self._connection:
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS queries ('
+                    'query TEXT PRIMARY KEY, count INTEGER NOT NULL, asked REAL NOT NULL)')
+        return self._connection
+
+    def record(self, query):
+        now = time.time()
+        with self._lock, self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO queries VALUES (?, 0, ?)', (query, now))
+            self.connection.execute('UPDATE queries SET count = count + 1, asked = ? WHERE query = ?', (now, query))
+
+    def top(self, limit):
+        """
+        Returns up to limit of the most frequent queries, most frequent first, breaking ties by the most recently asked.
+        """
+        with self._lock:
+            return [row[0] for row in self.connection.execute(
+                'SELECT query FROM queries ORDER BY count DESC, asked DESC LIMIT ?', (limit,))]
+
+    def clear(self):
+        with self._lock, self.connection:
+            self.connection.execute('DELETE FROM queries')
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+_kb_stream_loader = None
+
+def get_kb_stream_loader():
+    """
+    Returns a loader that can build the nodes of a YAML document one at a time.
+
+    The libyaml parser doesn't expose its composer, so its much faster event parser is combined with
+    the pure-Python composer and constructor. Without libyaml, the pure-Python loader is used.
+    """
+    global _kb_stream_loader # pylint: disable=global-statement
+    if _kb_stream_loader is None:
+        yaml = get_yaml()
+        try:
+            from yaml.cyaml import CParser
+        except ImportError:
+            _kb_stream_loader = yaml.FullLoader
+        else:
+            from yaml.composer import Composer
+            from yaml.constructor import FullConstructor
+            from yaml.resolver import Resolver
+
+            class CStreamLoader(CParser, Composer, FullConstructor, Resolver): # pylint: disable=too-many-ancestors
+
+                def __init__(self, stream):
+                    CParser.__init__(self, stream)
+                    Composer.__init__(self)
+                    FullConstructor.__init__(self)
+                    Resolver.__init__(self)
+
+            _kb_stream_loader = CStreamLoader
+    return _kb_stream_loader
+
+def iter_yaml_items(stream):
+    """
+    Parses the top-level list in the given YAML stream, yielding each entry as soon as it's read,
+    so memory use is proportional to the largest entry rather than the whole file.
+
+    Nothing is yielded if the document isn't a list.
+    """
+    from yaml.events import StreamEndEvent, SequenceStartEvent, SequenceEndEvent
+    loader = get_kb_stream_loader()(stream)
+    try:
+        loader.get_event() # StreamStartEvent
+        if loader.check_event(StreamEndEvent):
+            return
+        loader.get_event() # DocumentStartEvent
+        if not loader.check_event(SequenceStartEvent):
+            return
+        loader.get_event()
+        while not loader.check_event(SequenceEndEvent):
+            yield loader.construct_document(loader.compose_node(None, None))
+    finally:
+        loader.dispose()
+
+PARSE_CACHE_VERSION = 3
+
+def get_file_hash(fn):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def get_parse_cache_filename(path, cache_dir):
+    return os.path.join(cache_dir, get_text_hash(path)[:40] + '.pickle')
+
+def get_parse_cache_header(fn, cache_dir):
+    """
+    Returns the header of the given knowledge base file's parse cache,
+    or an empty dictionary if there's no cache or the file has been touched since it was written.
+    """
+    path = os.path.abspath(fn)
+    try:
+        stat = os.stat(path)
+        with open(get_parse_cache_filename(path, cache_dir), 'rb') as fin:
+            header = pickle.load(fin)
+        if header['version'] == PARSE_CACHE_VERSION and header['path'] == path \
+                and (header['mtime'], header['size']) == (stat.st_mtime, stat.st_size):
+            return header
+    except (IOError, OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError):
+        pass
+    return {}
+
+def get_kb_file_hash(fn, cache_dir=None):
+    """
+    Returns the content hash of the given knowledge base file,
+    reading it from the file's parse cache, without hashing the file again, if the file hasn't been touched since.
+    """
+    header = get_parse_cache_header(fn, cache_dir) if cache_dir else {}
+    if header:
+        return header['content_hash']
+    return get_file_hash(os.path.abspath(fn))
+
+def parse_date(value):
+    """
+    Returns the datetime given in a knowledge base answer, trying the usual year-month-day format
+    before falling back to the much slower, but more lenient, dateutil parser.
+    """
+    if not isinstance(value, string_types):
+        return value
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        pass
+    try:
+        import dateutil.parser
+        return dateutil.parser.parse(value)
+    except ValueError as e:
+        raise ValueError('Invalid date: %s' % value) from e
+
+def iter_kb_file(fn, cache_dir=None):
+    """
+    Yields the entries in the given knowledge base file, one at a time, as they're parsed.
+
+    If a cache directory is given, each parsed entry is pickled there as it's read, and the entries are read
+    back from there, again one at a time, until the file changes, as identified by its path, modification time,
+    size and content hash.
+    """
+    if not cache_dir:
+        with open(fn) as fin:
+            for item in iter_yaml_items(fin):
+                yield item
+        return
+
+    path = os.path.abspath(fn)
+    stat = os.stat(path)
+    cache_fn = get_parse_cache_filename(path, cache_dir)
+    content_hash = None
+    fin = None
+    items = None
+    current = False
+    try:
+        if os.path.isfile(cache_fn):
+            try:
+                fin = open(cache_fn, 'rb')
+                header = pickle.load(fin)
+                if header['version'] == PARSE_CACHE_VERSION and header['path'] == path:
+                    if (header['mtime'], header['size']) == (stat.st_mtime, stat.st_size):
+                        items = _iter_pickled(fin)
+                        current = True
+                    else:
+                        # The file was touched, but may not have actually changed.
+                        content_hash = get_file_hash(path)
+                        if header['content_hash'] == content_hash:
+                            items = _iter_pickled(fin)
+            except (EOFError, KeyError, TypeError, pickle.UnpicklingError):
+                pass
+
+        if current:
+            for item in items:
+                yield item
+            return
+
+        if items is None:
+            if fin is not None:
+                fin.close()
+            fin = open(path)
+            content_hash = content_hash or get_file_hash(path)
+            items = iter_yaml_items(fin)
+
+        # Write the cache as the entries are read, and only keep it if every entry was read.
+        cache = ParseCacheWriter(cache_fn, path, stat, content_hash)
+        try:
+            for item in items:
+                cache.dump(item)
+                yield item
+            cache.commit()
+        finally:
+            cache.abort()
+    finally:
+        if fin is not None:
+            fin.close()
+
+def _iter_pickled(fin):
+    while True:
+        try:
+            yield pickle.load(fin)
+        except EOFError:
+            return
+
+def load_kb_file(fn, cache_dir=None):
+    """
+    Returns the list of entries in the given knowledge base file, caching them like iter_kb_file.
+    """
+    return list(iter_kb_file(fn, cache_dir=cache_dir))
+
+def get_kb_includes(fn, cache_dir=None):
+    """
+    Parses the given knowledge base file, caching it, and returns the list of files it includes.
+    """
+    header = get_parse_cache_header(fn, cache_dir) if cache_dir else {}
+    if header:
+        return header['includes']
+    return [item['include'] for item in iter_kb_file(fn, cache_dir=cache_dir) if isinstance(item, dict) and 'include' in item]
+
+class KbPrefetcher():
+    """
+    Parses the files included by a knowledge base, and every file they include, in a pool of processes
+    in the background, to warm the parse cache while the entries are read in order in the foreground.
+
+    Files are only submitted once the foreground reaches the file including them,
+    so the pool is never started for a knowledge base without includes.
+    Each file is parsed once, no matter how many times it's included.
+    """
+
+    def __init__(self, cache_dir, jobs):
+        self.cache_dir = cache_dir
+        self.jobs = jobs
+        self.futures = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._pool = None
+        self._thread = None
+
+    def submit(self, fns):
+        """
+        Starts parsing the given files in the background, unless they already have been, or were claimed by the caller.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            for fn in fns:
+                path = os.path.realpath(fn)
+                if path in self.futures:
+                    continue
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.jobs)
+                self.futures[path] = self._pool.submit(get_kb_includes, fn, self.cache_dir)
+            if self._thread is None and self._pool is not None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        handled = set()
+        while True:
+            with self._lock:
+                pending = [future for future in self.futures.values() if future is not None and future not in handled]
+                if not pending:
+                    # Let the next submission start a new thread.
+                    self._thread = None
+                    return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                handled.add(future)
+                if not future.cancelled() and future.exception() is None:
+                    self.submit(future.result())
+
+    def wait_for(self, fn):
+        """
+        Waits until the given file is parsed, if it's already being parsed in the background.
+        Otherwise, marks it to be left to the caller, so it isn't parsed twice.
+        """
+        path = os.path.realpath(fn)
+        with self._lock:
+            future = self.futures.setdefault(path, None)
+        if future is not None:
+            try:
+                future.result()
+            except Exception: # pylint: disable=broad-except
+                # Let the error surface when the caller reads the file.
+                pass
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for future in self.futures.values():
+                if future is not None:
+                    future.cancel()
+            thread = self._thread
+        if self._pool is not None:
+            self._pool.shutdown()
+        if thread is not None:
+            thread.join()
+
+class ParseCacheWriter():
+    """
+    Writes the parse cache of a knowledge base file, a header followed by each entry pickled separately,
+    so it can be written and read back one entry at a time.
+
+    The header lists the files included by the file, so they can be parsed in the background
+    before its entries are read. Since they're only known once every entry has been read,
+    the entries are written to a separate file first, and copied after the header when the cache is committed.
+    """
 
-def find_true_link(s):
+    def __init__(self, cache_fn, path, stat, content_hash):
+        cache_dir = os.path.dirname(cache_fn)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_fn = cache_fn
+        self.tmp_fn = '%s.%i.%i.tmp' % (cache_fn, os.getpid(), threading.current_thread().ident)
+        self.entries_fn = self.tmp_fn + '.entries'
+        self.header = dict(
+            version=PARSE_CACHE_VERSION,
+            path=path,
+            mtime=stat.st_mtime,
+            size=stat.st_size,
+            content_hash=content_hash,
+            includes=[],
+        )
+        self.fout = open(self.entries_fn, 'wb')
+
+    def dump(self, item):
+        if isinstance(item, dict) and 'include' in item:
+            self.header['includes'].append(item['include'])
+        pickle.dump(item, self.fout, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def commit(self):
+        self.fout.close()
+        with open(self.tmp_fn, 'wb') as fout:
+            pickle.dump(self.header, fout, protocol=pickle.HIGHEST_PROTOCOL)
+            with open(self.entries_fn, 'rb') as fin:
+                shutil.copyfileobj(fin, fout)
+        os.rename(self.tmp_fn, self.cache_fn)
+
+    def abort(self):
+        if not self.fout.closed:
+            self.fout.close()
+        for fn in (self.tmp_fn, self.entries_fn):
+            if os.path.isfile(fn):
+                os.remove(fn)
+
+def normalize_doc(doc):
     """
-    Sometimes Google wraps our links inside sneaky tracking links, which often fail and slow us down
-    so remove them.
+    Returns a JSON-compatible copy of an index document and the hash of its content.
     """
-    # Convert "/url?q=<real_url>" to "<real_url>".
-    if s and s.startswith('/') and 'http' in s:
-        s = s[s.find('http'):]
-    return s
+    normalized = json.loads(json.dumps(doc, sort_keys=True, default=text_type))
+    return normalized, get_text_hash(json.dumps(normalized, sort_keys=True))
 
 class HowDoU():
 
     def __init__(self, **kwargs):
         kwargs.setdefault('verbose', False)
+        kwargs.setdefault('backend', DEFAULT_BACKEND)
+        kwargs.setdefault('index_batch_size', 500)
+        kwargs.setdefault('index_concurrency', 1)
+        kwargs.setdefault('es_hosts', ES_HOSTS)
+        kwargs.setdefault('es_timeout', ES_TIMEOUT)
+        kwargs.setdefault('jobs', os.cpu_count() or 1)
+        kwargs.setdefault('disable_cache', DISABLE_CACHE)
+        kwargs.setdefault('cache_ttl', CACHE_TTL)
+        kwargs.setdefault('cache_max_size', CACHE_MAX_SIZE)
+        kwargs.setdefault('connect_timeout', CONNECT_TIMEOUT)
+        kwargs.setdefault('read_timeout', READ_TIMEOUT)
+        kwargs.setdefault('retries', RETRIES)
+        kwargs.setdefault('max_workers', MAX_WORKERS)
+        kwargs.setdefault('batch', None)
+        kwargs.setdefault('output_format', OUTPUT_FORMAT)
+        kwargs.setdefault('profile', False)
+        kwargs.setdefault('profile_file', None)
+        kwargs.setdefault('cprofile_file', None)
+        kwargs.setdefault('tracemalloc', False)
+        kwargs.setdefault('batch_workers', BATCH_WORKERS)
+        kwargs.setdefault('socket_path', SOCKET_PATH)
+        kwargs.setdefault('daemon_timeout', DAEMON_TIMEOUT)
+        kwargs.setdefault('prerender', PRERENDER)
+        kwargs.setdefault('dump_site', DUMP_SITE)
+        kwargs.setdefault('dump_min_score', 0)
+        kwargs.setdefault('checkpoint_interval', DUMP_CHECKPOINT_INTERVAL)
+        kwargs.setdefault('disable_query_log', DISABLE_QUERY_LOG)
+        kwargs.setdefault('warm_limit', WARM_LIMIT)
+        kwargs.setdefault('warm_workers', WARM_WORKERS)
+        kwargs.setdefault('detach', False)
+        # Cached web requests expiring within this many seconds are fetched again.
+        kwargs.setdefault('cache_min_ttl', 0)
         self.__dict__.update(kwargs)
 
         if self.verbose:
             print('kwargs:')
             pprint(kwargs, indent=4)
         assert self.action in ACTIONS, 'Invalid action "%s". Must be one of %s' % (self.action, ', '.join(ACTIONS))
+        assert self.output_format in FORMATS, \
+            'Invalid format "%s". Must be one of %s' % (self.output_format, ', '.join(FORMATS))
+        assert self.backend in BACKENDS, 'Invalid backend "%s". Must be one of %s' % (self.backend, ', '.join(BACKENDS))
 
         self.cache_file = os.path.join(self.cache_dir, 'cache')
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.response_cache = ResponseCache(self.cache_file, max_size=int(self.cache_max_size * 1024 * 1024), ttl=self.cache_ttl)
+        self.query_log = QueryLog(os.path.join(self.cache_dir, 'queries'))
 
         self.query = (' '.join(self.query).replace('?', '')).strip()
 
         self.kb_filename = os.path.expanduser(self.kb_filename)
         self.kb_timestamp = os.path.expanduser(self.kb_timestamp)
         self.kb_app_dir = os.path.expanduser(self.kb_app_dir)
+        self.kb_parse_cache_dir = os.path.join(self.kb_app_dir, 'parse-cache')
+        # Each backend and index keeps its own record of what was indexed, so one can be reindexed without the other.
+        index_key = '%s-%s' % (self.backend, self.kb_index_name)
+        self.kb_index_dir = os.path.join(self.kb_app_dir, 'indexes', index_key)
+        self.kb_index_timestamp = '%s-%s' % (self.kb_timestamp, index_key)
 
         self.append_header = False
 
+        self.tags = []
+
         self.last_reindex_count = 0
 
+        self.search_backend = BACKENDS[self.backend](self)
+
+        # Older versions only supported Elasticsearch, and recorded what they indexed directly in the app directory.
+        self.manifest = IndexManifest(
+            self.kb_index_dir, legacy_dir=self.kb_app_dir if self.backend == ElasticsearchBackend.name else None)
+
+        self.query_memory_cache = MemoryCache(QUERY_CACHE_ENTRIES)
+        self.query_cache = ResponseCache(
+            os.path.join(self.kb_index_dir, 'query-cache.sqlite3'), max_size=QUERY_CACHE_MAX_SIZE, ttl=QUERY_CACHE_TTL)
+        self.query_cache_stats = dict(memory_hits=0, disk_hits=0, misses=0)
+
+        self.profiler = Profiler(enabled=bool(self.profile or self.profile_file or self.cprofile_file or self.tracemalloc))
+
     def delete_index(self):
         """
         Forcibly deletes the index from the server.
         """
         print('Deleting index %s...' % self.kb_index_name)
-        es = Elasticsearch()
-        es.indices.delete(index=self.kb_index_name, ignore=[400, 404])
-        print('Deleting index cache at %s...' % self.kb_app_dir)
-        os.system('rm -Rf %s/*' % self.kb_app_dir)
+        self.search_backend.delete_index()
+        print('Deleting index cache at %s...' % self.kb_index_dir)
+        self.manifest.close()
+        self.manifest.delete_legacy_files()
+        self.query_cache.close()
+        self.query_memory_cache.clear()
+        # Leave the records of other backends and indexes sharing the app directory alone.
+        # The parse cache is checked against each file's size and modification time, so it's kept.
+        if os.path.isdir(self.kb_index_dir):
+            shutil.rmtree(self.kb_index_dir)
+        if os.path.isfile(self.kb_index_timestamp):
+            os.remove(self.kb_index_timestamp)
 
     def is_kb_updated(self):
         """
         Returns true if the knowledge base file has changed since the last run.
         """
-        if not os.path.isfile(self.kb_timestamp):
+        if not os.path.isfile(self.kb_index_timestamp):
             print('First-time indexing required.')
             return True
         kb_filenames = list(self.iter_kb(only_filenames=True))
         for kb_filename in kb_filenames:
             kb_last_modified = datetime.datetime.fromtimestamp(os.path.getmtime(kb_filename))
-            timestamp_last_modified = datetime.datetime.fromtimestamp(os.path.getmtime(self.kb_timestamp))
+            timestamp_last_modified = datetime.datetime.fromtimestamp(os.path.getmtime(self.kb_index_timestamp))
             if kb_last_modified > timestamp_last_modified:
                 print('Changes found.')
                 return True
         return False
 
     def update_kb_timestamp(self):
-        touch(self.kb_timestamp)
+        touch(self.kb_index_timestamp)
+
+    @property
+    def session(self):
+        """
+        Returns the HTTP session shared by all remote fetches, so connections are kept alive between requests.
+        """
+        if self._session is not None:
+            return self._session
+        # Fetches run in threads, so make sure only one of them creates the session.
+        with self._session_lock:
+            if self._session is None:
+                self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        session = requests.Session()
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=(500, 502, 503, 504),
+            # Once the retries run out, return the last error response instead of raising.
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=10)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['User-Agent'] = get_user_agent().random
+        session.proxies.update(get_proxies())
+        return session
 
     def get_result(self, url):
+        if not self.disable_cache:
+            text = self.response_cache.get(url, min_ttl=self.cache_min_ttl)
+            if text is not None:
+                self.vprint('Using cached response for %s.' % url)
+                self.profiler.count('web_cache_hits')
+                return text
+        from requests.exceptions import SSLError, ConnectionError as RequestsConnectionError, Timeout
+        t0 = time.time()
         try:
-            return requests.get(url, headers={'User-Agent': ua.random}, proxies=get_proxies()).text
+            with self.profiler.span('fetch'):
+                response = self.session.get(url, timeout=(self.connect_timeout, self.read_timeout))
         except SSLError as e:
             print('[ERROR] Encountered an SSL Error. Try using HTTP instead of '
                   'HTTPS by setting the environment variable "HOWDOU_DISABLE_SSL".\n')
             raise e
+        except (Timeout, RequestsConnectionError) as e:
+            # Treat an unreachable page like an empty one, so the query still finishes.
+            print('[ERROR] Unable to fetch %s: %s' % (url, e), file=sys.stderr)
+            return u''
+        if self.profiler.enabled:
+            self.profiler.count('web_requests')
+            self.profiler.count('bytes_fetched', len(response.content))
+        self.vprint('Fetched %s in %.3f seconds with status %s.' % (url, time.time() - t0, response.status_code))
+        # Don't cache errors, like Google refusing to answer because we've made too many queries.
+        if not self.disable_cache and response.ok:
+            self.response_cache.set(url, response.text)
+        return response.text
 
     def get_links(self, query):
-        localization_url = LOCALIZATON_URLS[self.lang]
-        result = self.get_result(SEARCH_URL.format(localization_url, url_quote(query)))
-        html = pq(result)
-        return [a.attrib['href'] for a in html('.l')] or [a.attrib['href'] for a in html('.r')('a')]
-
-    def format_output(self, code):
+        with self.profiler.span('get_links'):
+            localization_url = LOCALIZATON_URLS[self.lang]
+            result = self.get_result(SEARCH_URL.format(localization_url, url_quote(query)))
+            from pyquery import PyQuery as pq
+            with self.profiler.span('parse_html'):
+                html = pq(result)
+                return [a.attrib['href'] for a in html('.l')] or [a.attrib['href'] for a in html('.r')('a')]
+
+    def format_output(self, code, tags=None, formatter=None):
         if not self.color:
             return code
-        lexer = None
-
-        # try to find a lexer using the StackOverflow tags
+        # try to find a lexer using the knowledge base formatter, the StackOverflow tags
         # or the query arguments
-        for keyword in self.query.split() + self.tags:
-            try:
-                lexer = get_lexer_by_name(keyword)
-                break
-            except ClassNotFound:
-                pass
-
-        # no lexer found above, use the guesser
-        if not lexer:
-            lexer = guess_lexer(code)
+        tags = self.tags if tags is None else tags
+        with self.profiler.span('format_output'):
+            return highlight_code(code, ([formatter] if formatter else []) + self.query.split() + list(tags))
 
-        return highlight(code, lexer, TerminalFormatter(bg='dark'))
-
-    def get_answer(self, links):
+    def get_answer(self, links, pos=None):
         """
         Given search arguments and a links of web links (usually Stackoverflow),
         find the best answer to the search question.
         """
         #print('get_answer: args:', args, 'links:', links)
-        link = get_link_at_pos(links, self.pos)
+        link = get_link_at_pos(links, self.pos if pos is None else pos)
         if not link:
             return False, None
 
@@ -313,37 +1987,92 @@ class HowDoU():
         if self.link:
             return None, link
 
-        page = self.get_result(find_true_link(link) + '?answertab=votes')
-        html = pq(page)
-
-        first_answer = html('.answer').eq(0)
-        instructions = first_answer.find('pre') or first_answer.find('code')
-        self.tags = [t.text for t in html('.post-tag')]
-
-        if not instructions and not self.all:
-            text = first_answer.find('.post-text').eq(0).text()
-        elif self.all:
-            texts = []
-            for html_tag in first_answer.items('.post-text > *'):
-                current_text = html_tag.text()
-                if current_text:
-                    if html_tag[0].tag in ['pre', 'code']:
-                        texts.append(self.format_output(current_text))
-                    else:
-                        texts.append(current_text)
-            texts.append('\n---\nAnswer from {0}'.format(link))
-            text = '\n'.join(texts)
-        else:
-            text = self.format_output(instructions.eq(0).text())
-        if text is None:
-            text = NO_ANSWER_MSG
-        text = text.strip()
+        text, tags = self.get_answer_text(link)
+        self.tags = tags
         return text, link
 
+    def select_links(self, links):
+        """
+        Returns the question links ranked at positions pos through pos + num_answers - 1.
+        """
+        question_links = get_question_links(links)
+        # Like get_link_at_pos, fall back to the last link if there are fewer than pos links.
+        return question_links[self.pos-1:self.pos-1+self.num_answers] or question_links[-1:]
+
+    def iter_answers(self, links):
+        """
+        Fetches the answers to the question links ranked at positions pos through pos + num_answers - 1,
+        in parallel, and yields each (answer, link) tuple in rank order as soon as it's ready.
+        """
+        selected = self.select_links(links)
+        if not selected:
+            return
+        if self.link:
+            for link in selected:
+                yield None, link
+            return
+        pool = ThreadPoolExecutor(max_workers=min(len(selected), self.max_workers))
+        try:
+            for link, (text, _) in zip(selected, pool.map(self.get_answer_text, selected)):
+                yield text, link
+        finally:
+            pool.shutdown(wait=False)
+
+    def get_answer_text(self, link):
+        """
+        Downloads the question page at the given link and returns a tuple of (answer text, question tags).
+        """
+        with self.profiler.span('get_answer'):
+            record = self.get_answer_record(link)
+            tags = record['tags']
+
+            if record['code'] is None and not self.all:
+                text = record['post_text']
+            elif self.all:
+                texts = []
+                for tag, current_text in record['blocks']:
+                    if current_text:
+                        if tag in ['pre', 'code']:
+                            texts.append(self.format_output(current_text, tags))
+                        else:
+                            texts.append(current_text)
+                texts.append('\n---\nAnswer from {0}'.format(link))
+                text = '\n'.join(texts)
+            else:
+                text = self.format_output(record['code'], tags)
+            if text is None:
+                text = NO_ANSWER_MSG
+            text = text.strip()
+            return text, tags
+
+    def get_answer_record(self, link):
+        """
+        Returns the record extract_answer makes of the question page at the given link.
+
+        Records are cached like web requests, so a page is only ever parsed once.
+        The cached page itself isn't needed again, so it's soon evicted in favor of more recent ones.
+        """
+        url = find_true_link(link) + '?answertab=votes'
+        key = 'extract:%i:%s' % (EXTRACT_VERSION, url)
+        if not self.disable_cache:
+            cached = self.response_cache.get(key, min_ttl=self.cache_min_ttl)
+            if cached is not None:
+                self.profiler.count('extract_cache_hits')
+                return json.loads(cached)
+        page = self.get_result(url)
+        with self.profiler.span('parse_html'):
+            record = extract_answer(page)
+        if not self.disable_cache:
+            self.response_cache.set(key, json.dumps(record))
+        return record
+
     def run_clear_cache(self):
-        self.clear_cache()
+        with self.kb_lock(shared=False):
+            self.clear_cache()
 
     def clear_cache(self):
+        print('Deleting web request cache at %s...' % self.cache_file)
+        self.response_cache.clear()
         self.delete_index()
 
     def init_kb(self):
@@ -352,22 +2081,14 @@ class HowDoU():
                 fout.write(KNOWLEDGEBASE_STUB)
 
     def mark_indexed(self, question_str, answer_str):
-        hash_fn = os.path.join(self.kb_app_dir, get_text_hash(question_str))
-        hash_contents = get_text_hash(answer_str)
-        open(hash_fn, 'w').write(hash_contents)
+        self.manifest.add_many([(question_str, answer_str)])
 
     def is_indexed(self, question_str, answer_str):
         """
         Returns true if this exact combination has been previously indexed.
         Returns false otherwise.
         """
-        hash_fn = os.path.join(self.kb_app_dir, get_text_hash(question_str))
-        if not os.path.isfile(hash_fn):
-            return False
-        hash_contents = get_text_hash(answer_str)
-        if open(hash_fn).read() != hash_contents:
-            return False
-        return True
+        return bool(self.manifest.contains_many([(question_str, answer_str)]))
 
     def add_item(self, item):
         """
@@ -381,7 +2102,7 @@ class HowDoU():
             assert 'date' in answer
             assert 'text' in answer
             answer.setdefault('weight', 1.0)
-        item_str = yaml.dump([item], indent=4, default_flow_style=False)#, default_style='|')
+        item_str = get_yaml().dump([item], indent=4, default_flow_style=False)#, default_style='|')
         self.init_kb()
         with open(self.kb_filename, 'a') as fout:
             fout.write(item_str)
@@ -402,120 +2123,313 @@ class HowDoU():
                 cnt += len(item['answers'])
         return cnt
 
-    def iter_kb(self, fn=None, only_filenames=False):
+    def iter_kb(self, fn=None, only_filenames=False, invalid=None, skip=None):
         """
         Iterates over all knowledgebase entries.
+
+        Entries that aren't mappings are skipped with a warning, and if a list is given as invalid,
+        a tuple of the filename and the entry is appended to it for each.
+
+        If a function is given as skip, it's called with each filename, and if it returns true,
+        that file's entries are left out, though the files it includes are still read.
         """
         if not os.path.isdir(self.kb_app_dir):
             os.mkdir(self.kb_app_dir)
         if only_filenames and fn is None:
             yield self.kb_filename
         fn = fn or self.kb_filename
+        prefetcher = None
+        if not only_filenames and self.jobs > 1:
+            prefetcher = KbPrefetcher(self.kb_parse_cache_dir, self.jobs)
         try:
-            for item in yaml.load(open(fn), Loader=yaml.FullLoader):
-                if isinstance(item, dict) and 'include' in item:
-                    # Handle special "include" entries that direct us to load an additional file.
-                    if only_filenames:
-                        yield item['include']
-                    else:
-                        for _ in self.iter_kb(item['include']):
-                            yield _
-                else:
-                    # Otherwise, yield normal entry.
-                    # Dynamically add filename so it can be indexed and included in search results.
-                    item['filename'] = fn
-                    yield item
-        except TypeError:
-            return
+            if prefetcher:
+                # Resolve the files the root includes before reading its entries, so they're all parsed at once,
+                # along with the files they include in turn, while the entries are read in order.
+                # This streams the root into its parse cache, so reading its entries afterwards is cheap.
+                prefetcher.wait_for(fn)
+                prefetcher.submit(get_kb_includes(fn, cache_dir=self.kb_parse_cache_dir))
+            for item in self._iter_kb_file(
+                    fn, only_filenames, visited=set(), prefetcher=prefetcher, invalid=invalid, skip=skip):
+                yield item
+        finally:
+            if prefetcher:
+                prefetcher.close()
+
+    def _iter_kb_file(self, fn, only_filenames, visited, prefetcher=None, invalid=None, skip=None):
+        visited.add(os.path.realpath(fn))
+        if prefetcher:
+            prefetcher.wait_for(fn)
+            # Start parsing the files this one includes, if they weren't already found while parsing it.
+            # Should the file have changed since, any others are handed over as their entries are reached.
+            header = get_parse_cache_header(fn, self.kb_parse_cache_dir)
+            if header:
+                prefetcher.submit([_ for _ in header['includes'] if os.path.realpath(_) not in visited])
+        skipped = not only_filenames and skip is not None and skip(fn)
+        for item in self.profiler.iterate('iter_kb', iter_kb_file(fn, cache_dir=self.kb_parse_cache_dir)):
+            if not isinstance(item, dict):
+                # Skip stray entries, like a bare string, rather than giving up on the rest of the file.
+                if not only_filenames and not skipped:
+                    print('Skipping invalid entry in %s: %r' % (fn, item), file=sys.stderr)
+                    if invalid is not None:
+                        invalid.append((fn, item))
+                continue
+            if 'include' in item:
+                # Handle special "include" entries that direct us to load an additional file.
+                if os.path.realpath(item['include']) in visited:
+                    if not only_filenames:
+                        # Keep stdout clean for actions that print entries, like filter-by-field.
+                        print('Skipping %s, which was already included.' % item['include'], file=sys.stderr)
+                    continue
+                if only_filenames:
+                    yield item['include']
+                if prefetcher:
+                    prefetcher.submit([item['include']])
+                for _ in self._iter_kb_file(item['include'], only_filenames, visited, prefetcher, invalid, skip):
+                    yield _
+            elif only_filenames or skipped:
+                continue
+            else:
+                # Otherwise, yield normal entry.
+                # Dynamically add filename so it can be indexed and included in search results.
+                item['filename'] = fn
+                yield item
 
     def index_kb(self):
         """
         Processes all knowledgebase entries and enters them into the text search database.
         """
-        es = Elasticsearch()
-        count = 0
+        with self.profiler.span('index_kb'):
+            self._index_kb()
 
+    def _index_kb(self):
         if not os.path.isdir(self.kb_app_dir):
             os.mkdir(self.kb_app_dir)
 
+        # Estimate progress from the number of answers seen last time,
+        # rather than reading the whole knowledge base an extra time just to count them.
+        # This is read first, since forcing a reindex deletes it.
+        total = int(self.manifest.get_meta('total_answers') or 0)
+
         if self.force:
             self.delete_index()
         elif not self.is_kb_updated():
             print('No changes detected.')
             return
 
-        # Count total combinations so we can accurately measure progress.
         self.vprint('kb_filename:', self.kb_filename)
-        try:
-            total = self.count_total_kb_answers()
-        except yaml.scanner.ScannerError as exc:
-            traceback.print_exc()
-            self.show_gui_error('HowDoU Re-Indexing Error', exc)
-            sys.exit(1)
-
-        for item in self.iter_kb(self.kb_filename):
 
-            # Combine the list of separate questions into a single text block.
-            print('item:', item)
-            questions = u'\n'.join(map(text_type, item.get('questions') or []))
-            self.vprint('questions:', questions)
-            if not questions:
-                print('Skipping due to missing questions.')
-                continue
+        progress = dict(count=0)
+        pending = {}
+        stats = defaultdict(int)
 
-            for answer in item['answers']:
-                count += 1
-                sys.stdout.write('\rRe-indexing %i of %i...' % (count, total))
-                sys.stdout.flush()
+        # Files whose content hasn't changed since the last reindex are skipped,
+        # keeping the documents they produced last time, unless prerendering was since turned on or off.
+        if self.force or self.manifest.get_meta('prerender') != int(bool(self.prerender)):
+            previous_files = {}
+        else:
+            previous_files = self.manifest.get_files()
+        file_hashes = {}
+        file_answers = defaultdict(int)
+        skipped_files = set()
+        invalid = []
+        # Documents whose source changed, but not in any way that changes the document itself.
+        unsent = []
+
+        def _skip(fn):
+            file_hashes[fn] = get_kb_file_hash(fn, self.kb_parse_cache_dir)
+            if fn in previous_files and previous_files[fn][0] == file_hashes[fn]:
+                skipped_files.add(fn)
+                return True
+            return False
 
-                if not self.force and self.is_indexed(questions, answer['text']):
+        def _iter_answers():
+            """
+            Yields a tuple of (doc_id, source_hash, questions, answer, filename) for every answer in the changed files.
+            """
+            seen = set()
+            for item in self.iter_kb(self.kb_filename, invalid=invalid, skip=_skip):
+
+                # Combine the list of separate questions into a single text block.
+                self.vprint('item:', item)
+                questions = u'\n'.join(map(text_type, item.get('questions') or []))
+                self.vprint('questions:', questions)
+                if not questions:
+                    print('Skipping due to missing questions.')
                     continue
 
-                weight = float(answer.get('weight', 1))
-                dt = answer['date']
-                if isinstance(dt, string_types):
-                    try:
-                        dt = dateutil.parser.parse(dt)
-                    except ValueError as e:
-                        raise Exception('Invalid date: %s' % dt)
-
-                text = questions + ' ' + answer['text']
-
-                _id = get_text_hash(text)
-
-                doc = dict(
-                    questions=questions,
-                    answer=answer['text'],
-                    source=answer.get('source', ''),
-                    filename=item['filename'],
-                    text=text,
-                    action_subject=answer.get('action_subject'),
-                    timestamp=dt,
-                    weight=weight,
-                )
-                if self.verbose:
-                    print('doc:')
-                    pprint(doc, indent=4)
-
-                # Register this combination in the database.
-                # https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.Elasticsearch.index
-                es.index(
-                    id=_id,
-                    index=self.kb_index_name,
-                    doc_type='text',
-    #                properties=dict(
-    #                    text=dict(type='string', boost=weight)
-    #                ),
-                    body=doc,
-                )
-
-                # Record a hash of this combination so we can skip it next time.
-                self.mark_indexed(questions, answer['text'])
+                for answer in item['answers']:
+                    progress['count'] += 1
+                    file_answers[item['filename']] += 1
+                    if total:
+                        sys.stdout.write('\rRe-indexing %i of ~%i...' % (progress['count'], max(total, progress['count'])))
+                    else:
+                        sys.stdout.write('\rRe-indexing %i...' % progress['count'])
+                    sys.stdout.flush()
 
+                    _id = get_text_hash(questions + ' ' + answer['text'])
+                    if _id in seen:
+                        continue
+                    seen.add(_id)
+                    # Everything the document is built from goes into this hash,
+                    # so an unchanged answer can be skipped before its document is even built.
+                    source_hash = get_text_hash(json.dumps(
+                        [questions, item['filename'], self.prerender, answer], sort_keys=True, default=text_type))
+                    yield _id, source_hash, questions, answer, item['filename']
+
+        def _get_doc(questions, answer, filename):
+            text = questions + ' ' + answer['text']
+            doc = dict(
+                questions=questions,
+                answer=answer['text'],
+                source=answer.get('source', ''),
+                filename=filename,
+                text=text,
+                action_subject=answer.get('action_subject'),
+                timestamp=parse_date(answer['date']),
+                weight=float(answer.get('weight', 1)),
+                formatter=answer.get('formatter'),
+            )
+            if self.prerender:
+                doc['highlighted'] = highlight_code(answer['text'], [answer['formatter']] if answer.get('formatter') else [])
+            return doc
+
+        def _iter_batch_actions(batch):
+            """
+            Compares a batch of answers against what was sent last time, looking them all up at once,
+            and yields the actions needed to send only the difference.
+            """
+            source_hashes = {} if self.force else self.manifest.get_source_hashes([_[0] for _ in batch])
+            changed = [_ for _ in batch if _[0] not in source_hashes or source_hashes[_[0]] != _[1]]
+            previous = self.manifest.get_many([_[0] for _ in changed if _[0] in source_hashes])
+            for _id, source_hash, questions, answer, filename in changed:
+                doc = _get_doc(questions, answer, filename)
+                normalized, content_hash = normalize_doc(doc)
+                if _id not in previous:
+                    stats['added'] += 1
+                    action = {'_op_type': 'index', '_id': _id, '_source': doc}
+                elif previous[_id][0] != content_hash:
+                    stats['changed'] += 1
+                    old = previous[_id][1]
+                    if set(old) - set(normalized):
+                        # A partial update can't remove fields, like highlighted once prerendering is turned off,
+                        # so replace the whole document.
+                        action = {'_op_type': 'index', '_id': _id, '_source': doc}
+                    else:
+                        # Partially update the document with only the fields that changed.
+                        partial = dict((k, v) for k, v in doc.items() if old.get(k) != normalized[k])
+                        action = {'_op_type': 'update', '_id': _id, '_source': {'doc': partial}}
+                else:
+                    unsent.append((_id, source_hash))
+                    continue
+                pending[_id] = (questions, answer['text'], content_hash, normalized, filename, source_hash)
+                if self.verbose:
+                    print('action:')
+                    pprint(action, indent=4)
+                yield action
+
+        def _iter_actions():
+            seen = set()
+            batch = []
+            for answer in _iter_answers():
+                seen.add(answer[0])
+                batch.append(answer)
+                if len(batch) >= self.index_batch_size:
+                    for action in _iter_batch_actions(batch):
+                        yield action
+                    batch = []
+            for action in _iter_batch_actions(batch):
+                yield action
+
+            # Anything indexed last time that no longer exists in the knowledge base is stale.
+            # This is only reached once every file was read to the end, since any error reading one ends the loop above.
+            # A skipped entry may still hold answers that are indexed, so then nothing is removed.
+            if invalid and not self.force:
+                print('\nNot removing stale documents, since %i entries were invalid.' % len(invalid), file=sys.stderr)
+            elif not self.force:
+                for _id, filename in list(self.manifest.iter_doc_filenames()):
+                    if _id not in seen and filename not in skipped_files:
+                        stats['removed'] += 1
+                        pending[_id] = None
+                        yield {'_op_type': 'delete', '_id': _id}
+
+        # Time reading the knowledge base separately, so the reported throughput only covers sending documents.
+        scan = dict(seconds=0)
+
+        def _timed(actions):
+            while True:
+                t0 = time.time()
+                try:
+                    action = next(actions)
+                except StopIteration:
+                    return
+                finally:
+                    scan['seconds'] += time.time() - t0
+                yield action
+
+        # Stream all changes into the database in batches.
+        sent = errors = 0
+        indexed = []
+        deleted = []
+
+        def _flush():
+            self.manifest.save_many(indexed)
+            self.manifest.delete_many(deleted)
+            del indexed[:]
+            del deleted[:]
+
+        t0 = time.time()
+        try:
+            for ok, op_type, _id, error in self.search_backend.bulk(
+                    _timed(_iter_actions()), batch_size=self.index_batch_size, concurrency=self.index_concurrency):
+                sent += 1
+                record = pending.pop(_id)
+                self.profiler.count('docs_indexed' if ok else 'docs_failed')
+                if ok:
+                    # Record a hash of this document so we can skip it next time.
+                    if record is None:
+                        deleted.append(_id)
+                    else:
+                        indexed.append((_id,) + record)
+                    if len(indexed) + len(deleted) >= self.index_batch_size:
+                        _flush()
+                else:
+                    errors += 1
+                    print('\nError on %s of %s: %s' % (op_type, _id, error), file=sys.stderr)
+        except get_yaml().YAMLError as exc:
+            _flush()
+            traceback.print_exc()
+            self.show_gui_error('HowDoU Re-Indexing Error', exc)
+            sys.exit(1)
+        _flush()
+        self.manifest.set_source_hashes(unsent)
+        if sent:
+            self.manifest.set_meta('generation', '%f' % time.time())
+        self.search_backend.refresh()
+        td = max(time.time() - t0 - scan['seconds'], 0)
+
+        # Next time, skip the files indexed without any problems.
+        files = {}
+        for fn, content_hash in file_hashes.items():
+            if fn in skipped_files:
+                continue
+            files[fn] = None if errors else (content_hash, file_answers[fn])
+        for fn, _ in invalid:
+            files[fn] = None
+        for fn in previous_files:
+            if fn not in file_hashes:
+                files[fn] = None
+        self.manifest.save_files(files)
+        self.manifest.set_meta('prerender', int(bool(self.prerender)))
+
+        # Skipped files still count towards the total, from the number of answers they had last time.
+        count = progress['count'] + sum(previous_files[fn][1] or 0 for fn in skipped_files)
+        self.manifest.set_meta('total_answers', count)
         self.last_reindex_count = count
-        es.indices.refresh(index=self.kb_index_name)
-        self.update_kb_timestamp()
-        print('\nRe-indexed %i items.' % (count,))
+        if not errors:
+            self.update_kb_timestamp()
+        print('\nRe-indexed %i items, skipping %i unchanged files.' % (count, len(skipped_files)))
+        print('Found %i added, %i changed and %i removed documents.' % (stats['added'], stats['changed'], stats['removed']))
+        print('Sent %i documents in %.2f seconds (%.1f docs/sec) with %i errors.' % (sent, td, sent/td if td else 0, errors))
 
     def vprint(self, *args):
         if self.verbose:
@@ -523,89 +2437,86 @@ class HowDoU():
             sys.stdout.flush()
 
     def get_local_answers(self, q=None):
+        """
+        Returns the local answers to the query, memoized until the index changes.
+        """
+        with self.profiler.span('get_local_answers'):
+            return self._get_local_answers(q)
 
-        def _get_search_results(exact=True):
-            # https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-query-string-query.html
-            # https://www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-function-score-query.html#CO158-1
-            # Order searches by a mix of how closely they match the query string
-            # along with the custom weight.
-            es_query = {
-                "query": {
-                    "function_score": {
-                        "boost": '5' if exact else '1',
-                        'query': {
-                            'query_string':{
-                                'query': query,
-                                'fields': ['questions'],
-                                'default_operator': 'AND' if exact else 'OR',
-                            },
-                        },
-                        "functions": [{
-                            "script_score": {
-                                "script" : {
-                                  "lang": "painless",
-                                  "inline": "_score * doc['weight'].value"
-                                },
-                            },
-                        }],
-                    }
-                }
-            }
-
-            if self.verbose:
-                print('es_query:')
-                pprint(es_query, indent=4)
-
-            results = es.search(index=self.kb_index_name, body=es_query)
-            return results
-
+    def _get_local_answers(self, q=None):
         query = q or self.query
         assert query and isinstance(query, string_types), 'Invalid query: %s' % query
+
+        # A forced reindex in another process deletes the manifest and query cache and writes new ones,
+        # so make sure a long-running process, like the daemon, isn't still reading the old ones.
+        if self.manifest.reopen_if_changed():
+            self.query_cache.close()
+            self.query_memory_cache.clear()
+
+        # Every reindex changes the generation, which invalidates all results cached for the previous one.
+        generation = self.manifest.get_meta('generation')
+        if not generation:
+            return [Answer(**answer) for answer in self.search_local_answers(query)]
+        # The cache lives in the app directory, which several backends and indexes may share.
+        key = json.dumps([
+            ' '.join(query.split()), self.backend, self.kb_index_name, self.num_answers, self.min_score, self.color,
+            generation])
+
+        answers = self.query_memory_cache.get(key)
+        if answers is not None:
+            self.query_cache_stats['memory_hits'] += 1
+        else:
+            cached = self.query_cache.get(key)
+            if cached is not None:
+                self.query_cache_stats['disk_hits'] += 1
+                answers = json.loads(cached)
+                self.query_memory_cache.set(key, answers)
+            else:
+                self.query_cache_stats['misses'] += 1
+                answers = self.search_local_answers(query)
+                self.query_memory_cache.set(key, answers)
+                self.query_cache.set(key, json.dumps(answers))
+        self.vprint('Query cache: %(memory_hits)i memory hits, %(disk_hits)i disk hits, %(misses)i misses.' \
+            % self.query_cache_stats)
+        return [Answer(**answer) for answer in answers]
+
+    def search_local_answers(self, query):
         answers = []
-        es = Elasticsearch()
         self.vprint('Checking for local answers at index %s...' % self.kb_index_name)
-        es.indices.create(index=self.kb_index_name, ignore=400)
-
-        # https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.Elasticsearch.search
-        #results = es.search(index=self.kb_index_name, body=es_query)
-        for method in [lambda: _get_search_results(exact=True), lambda: _get_search_results(exact=False)]:
-            results = method()
-            total = len(results['hits']['hits'])
-            self.vprint('Found %i results.' % total)
-            hits = results['hits']['hits'][:self.num_answers]
+
+        # Use the answer's highlighted text, if it was rendered when indexed, so colorizing costs nothing now.
+        fields = SOURCE_FIELDS + (['highlighted'] if self.color else [])
+        with self.profiler.span('search'):
+            hits = self.search_backend.search(query, size=self.num_answers, fields=fields)
+        self.vprint('Found %i results.' % len(hits))
+        for hit in hits:
             if self.verbose:
-                print('results:')
-                pprint(results, indent=4)
-            if hits:
-                for hit in hits:
-                    if self.verbose:
-                        print('hit:')
-                        pprint(hit, indent=4)
-                    answer_data = {}
-                    #TODO:sort/boost by weight?
-                    #TODO:ignore low weights?
-                    score = hit['_score']
-                    if self.min_score >= 0 and score < self.min_score:
-                        continue
+                print('hit:')
+                pprint(hit, indent=4)
+            answer_data = {}
+            #TODO:sort/boost by weight?
+            #TODO:ignore low weights?
+            score = hit['_score']
+            if self.min_score >= 0 and score < self.min_score:
+                continue
 
-                    answer_data['answer'] = hit['_source']['answer'].strip()
-                    answer_data['score'] = score
-                    answer_data['source'] = (hit['_source'].get('source') or '').strip() or None
-                    _fn = hit['_source']['filename']
-                    answer_data['filename'] = _fn
-                    answer_data['text'] = hit['_source']['text']
-                    answer_data['weight'] = hit['_source']['weight']
-                    answer_data['location'] = LOCAL
-                    if self.verbose:
-                        print('answer_data:')
-                        pprint(answer_data, indent=4)
-                    answers.append(answer_data)
-
-            # First try finding an entry with all the keywords using the AND operator.
-            # If nothing found, then continue by searching for entries with any of the keywords
-            # using the OR operator.
-            if total:
-                break
+            source = hit['_source']
+            if self.color:
+                answer_data['answer'] = (source.get('highlighted') \
+                    or self.format_output(source['answer'], tags=[], formatter=source.get('formatter'))).strip()
+            else:
+                answer_data['answer'] = source['answer'].strip()
+            answer_data['score'] = score
+            answer_data['source'] = (source.get('source') or '').strip() or None
+            answer_data['filename'] = source['filename']
+            # The text field is just the questions and answer combined, so rebuild it instead of fetching it.
+            answer_data['text'] = source['questions'] + ' ' + source['answer']
+            answer_data['weight'] = source['weight']
+            answer_data['location'] = LOCAL
+            if self.verbose:
+                print('answer_data:')
+                pprint(answer_data, indent=4)
+            answers.append(answer_data)
 
         return answers
 
@@ -616,85 +2527,490 @@ class HowDoU():
         return self.run_query(*args, **kwargs)
 
     def run_query(self, q=None, output=True):
+        with self.profiler.span('run_query'):
+            return self._run_query(q, output)
+
+    def _run_query(self, q=None, output=True):
+        answers = self.iter_query(q)
+        if answers is False:
+            if output and self.output_format != TEXT:
+                # Scripts parsing the output still expect a valid, if empty, result.
+                answers = iter([])
+            else:
+                return False
+
+        if output:
+            if self.output_format == TEXT:
+                output_str = self.format_answers(list(answers))
+                print_unicode(output_str)
+                return output_str
+            # Write each answer as soon as it's ready, instead of waiting on the slowest,
+            # and without keeping what was written, so memory use doesn't grow with the number of answers.
+            for chunk in self.iter_serialized(answers):
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
+            return True
+
+        return list(answers)
+
+    def iter_query(self, q=None):
+        """
+        Returns an iterator over the answers to the query, as Answer instances,
+        or False if nothing was found locally and the web search returned no links.
+
+        Remote answers are fetched lazily, so each can be used as soon as it arrives.
+        """
         query = q or self.query
 
         # Elasticsearch tokenizes text on certain non-alphanumeric characters,
         # so increase a queries chances of finding an exact match by removing these tokens.
         query = re.sub(r'[\:\-]+', ' ', query)
 
-        answers = []
-        if query:
-            with fasteners.InterProcessLock(self.kb_lockfile_path):
+        if not query:
+            return iter([])
+
+        t0 = time.time()
+        self.append_header = self.num_answers > 1 or self.show_score or self.show_source
+        #initial_position = self.pos
 
+        self.vprint('Querying %s...' % query)
+
+        # Check local index first.
+        #http://elasticsearch.org/guide/reference/query-dsl/
+        #http://www.elasticsearch.org/guide/en/elasticsearch/reference/current/query-dsl-query-string-query.html
+        # Only a shared lock is needed to read, so concurrent queries don't wait on each other.
+        answers = []
+        if not self.ignore_local:
+            with self.kb_lock(shared=True):
                 self.init_kb()
+                answers.extend(self.get_local_answers(query))
+            for answer in answers:
+                answer.seconds = time.time() - t0
+
+        # If we found nothing satisfying locally, then search the net.
+        # This doesn't touch the index, so it's done without holding any lock.
+        if answers or self.ignore_remote:
+            return iter(answers)
+        if not self.disable_query_log:
+            self.query_log.record(query)
+        links = self.get_links(query)
+        if not links:
+            return False
+        return self.iter_remote_answers(links, t0)
 
-                # enable the cache if user doesn't want it to be disabled
-                # if not self.disable_cache:
-                    # self.enable_cache()
-
-                self.append_header = self.num_answers > 1 or self.show_score or self.show_source
-                #initial_position = self.pos
-
-                self.vprint('Querying %s...' % query)
-
-                # Check local index first.
-                #http://elasticsearch.org/guide/reference/query-dsl/
-                #http://www.elasticsearch.org/guide/en/elasticsearch/reference/current/query-dsl-query-string-query.html
-                if not self.ignore_local:
-                    answers.extend(self.get_local_answers(query))
-
-                # If we found nothing satisfying locally, then search the net.
-                if not answers and not self.ignore_remote:
-                    links = self.get_links(query)
-                    if not links:
-                        return False
-                    for answer_number in range(self.num_answers):
-                        result = self.get_answer(links)
-                        answer, link = result
-                        if not answer and not link:
-                            continue
+    def iter_remote_answers(self, links, t0):
+        for answer, link in self.iter_answers(links):
+            yield Answer(answer, score=1.0, weight=1.0, location=REMOTE, source=link, seconds=time.time() - t0)
 
-                        answer_data = {}
-                        answer_data['answer'] = answer
-                        answer_data['score'] = 1.0
-                        answer_data['source'] = link
-                        answer_data['filename'] = None
-                        answer_data['text'] = None
-                        answer_data['weight'] = 1.0
-                        answer_data['location'] = REMOTE
-                        answers.append(answer_data)
+    def format_answers(self, answers):
+        """
+        Renders a list of answers as shown on the command line, in the configured output format.
+        """
+        if self.output_format != TEXT:
+            return u''.join(self.iter_serialized(answers))
+        s = []
+        for i, answer in enumerate(answers):
+            if answer['location'] == LOCAL:
+                source = answer['filename']
+            else:
+                source = answer['source']
+            score = int(round(answer['score'] or 0, 0))
+            weight = int(answer['weight'] or 0)
+            s.append(ANSWER_HEADER.format(
+                i=i+1,
+                weight=score*weight,
+                answer=answer['answer'],
+                source=source))
+        return u'\n' + (u'\n\n'.join(s)) + u'\n'
+
+    def iter_serialized(self, answers):
+        """
+        Serializes the answers as either a JSON list or one JSON object per line,
+        yielding each piece as soon as its answer is available.
+        """
+        if self.output_format == NDJSON:
+            for answer in answers:
+                yield json.dumps(answer.as_dict()) + u'\n'
+            return
+        separator = u'[\n'
+        for answer in answers:
+            yield separator + json.dumps(answer.as_dict())
+            separator = u',\n'
+        yield u'[]\n' if separator == u'[\n' else u'\n]\n'
 
-        if output:
-            s = []
-            for i, answer in enumerate(answers):
-                if answer['location'] == LOCAL:
-                    source = answer['filename']
-                else:
-                    source = answer['source']
-                score = int(round(answer['score'] or 0, 0))
-                weight = int(answer['weight'] or 0)
-                s.append(ANSWER_HEADER.format(
-                    i=i+1,
-                    weight=score*weight,
-                    answer=answer['answer'],
-                    source=source))
-
-            output_str = u'\n' + (u'\n\n'.join(s)) + u'\n'
-            output_str.encode('utf-8', 'replace')
+    def run_batch(self, stream=None):
+        """
+        Answers each question in the batch file, one per line, running up to batch_workers queries at a time.
+        Results are printed as soon as they're ready, followed by a summary of the throughput and latency.
+        With the JSON formats, each result is printed as one line holding the query and its answers.
+        """
+        if stream is None:
+            stream = sys.stdin if self.batch == '-' else io.open(self.batch, encoding='utf-8')
+
+        def timed_query(query):
+            t0 = time.time()
             try:
-                # Try to print unicode.
-                print(output_str)
-            except UnicodeEncodeError:
-                # If the console forces us to use ASCII, then force ASCII.
-                print(output_str.encode('ascii', 'replace'))
-            return output_str
+                answers = self.run_query(query, output=False)
+            except Exception as exc: # pylint: disable=broad-except
+                answers = exc
+            return query, answers, time.time() - t0
+
+        # Create the knowledge base once up front, instead of in every worker.
+        if not self.ignore_local:
+            with self.kb_lock(shared=True):
+                self.init_kb()
 
-        return answers
+        latencies = []
+        errors = []
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=max(self.batch_workers, 1)) as executor:
+            pending = set()
+
+            def handle(done):
+                for future in done:
+                    query, answers, latency = future.result()
+                    latencies.append(latency)
+                    if isinstance(answers, Exception):
+                        print('Error answering "%s": %s' % (query, answers), file=sys.stderr)
+                        errors.append(query)
+                        continue
+                    if self.output_format != TEXT:
+                        # Results arrive in no particular order, so each is written as a separate line tagged with its query.
+                        sys.stdout.write(json.dumps(OrderedDict([
+                            ('query', query),
+                            ('seconds', latency),
+                            ('answers', [answer.as_dict() for answer in answers or []]),
+                        ])) + u'\n')
+                        sys.stdout.flush()
+                        continue
+                    print_unicode(u'=== %s ===' % query)
+                    print_unicode(self.format_answers(answers) if answers else u'\nNo answers found.\n')
+                    sys.stdout.flush()
+
+            # Only keep a bounded number of queries in flight, so a large stdin stream isn't read all at once.
+            try:
+                for line in stream:
+                    query = line.strip()
+                    if not query or query.startswith('#'):
+                        continue
+                    if len(pending) >= self.batch_workers * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        handle(done)
+                    pending.add(executor.submit(timed_query, query))
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    handle(done)
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+        td = time.time() - t0
+
+        stats = dict(
+            queries=len(latencies),
+            errors=len(errors),
+            seconds=td,
+            queries_per_second=len(latencies) / td if td else 0,
+            p50=percentile(latencies, 50),
+            p99=percentile(latencies, 99),
+        )
+        print(
+            'Answered %(queries)i queries, with %(errors)i errors, '
+            'in %(seconds).2f seconds (%(queries_per_second).1f queries/sec). '
+            'Latency p50 %(p50).3f seconds, p99 %(p99).3f seconds.' % stats, file=sys.stderr)
+        return stats
+
+    def run_warm(self):
+        if not self.detach:
+            return self.warm()
+        # Fork a detached process, so the command returns at once and the warm-up survives the terminal closing.
+        pid = os.fork()
+        if pid:
+            print('Warming the cache in the background, as process %i.' % pid)
+            return
+        try:
+            os.setsid()
+            log_fn = os.path.join(self.cache_dir, 'warm.log')
+            with open(os.devnull, 'r') as devnull, open(log_fn, 'a') as log:
+                os.dup2(devnull.fileno(), sys.stdin.fileno())
+                os.dup2(log.fileno(), sys.stdout.fileno())
+                os.dup2(log.fileno(), sys.stderr.fileno())
+            self.warm()
+        except Exception: # pylint: disable=broad-except
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0) # pylint: disable=protected-access
+
+    def warm(self):
+        """
+        Fetches the search results and answers for the most frequently asked remote queries,
+        running up to warm_workers requests at a time, so the next time they're asked they're answered from the cache.
+
+        Cached pages past half of their time-to-live are fetched again, so popular answers never expire.
+        """
+        assert not self.disable_cache, 'Warming has no effect with the cache disabled.'
+        queries = self.query_log.top(self.warm_limit)
+        min_ttl, self.cache_min_ttl = self.cache_min_ttl, self.cache_ttl / 2.
+        stats = dict(queries=0, answers=0, errors=0)
+        t0 = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=max(self.warm_workers, 1)) as executor:
+                # Each query's answers are queued as soon as its links arrive, sharing the same bounded pool.
+                pending = dict((executor.submit(self.get_links, query), ('queries', query)) for query in queries)
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        kind, name = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as exc: # pylint: disable=broad-except
+                            stats['errors'] += 1
+                            print('Error warming "%s": %s' % (name, exc), file=sys.stderr)
+                            continue
+                        stats[kind] += 1
+                        if kind == 'queries' and not self.link:
+                            for link in self.select_links(result):
+                                pending[executor.submit(self.get_answer_record, link)] = ('answers', link)
+        finally:
+            self.cache_min_ttl = min_ttl
+        stats['seconds'] = time.time() - t0
+        print('Warmed %(queries)i queries and %(answers)i answers, with %(errors)i errors, in %(seconds).2f seconds.' % stats)
+        return stats
+
+    def clone(self, **kwargs):
+        """
+        Returns a new instance configured with the given options,
+        reusing this instance's connections, index handles and caches wherever the options allow.
+        """
+        other = HowDoU(**kwargs)
+        if (other.backend, other.kb_index_name, other.kb_app_dir, other.es_hosts) \
+                == (self.backend, self.kb_index_name, self.kb_app_dir, self.es_hosts):
+            other.search_backend = self.search_backend
+            other.manifest = self.manifest
+            other.query_memory_cache = self.query_memory_cache
+            other.query_cache = self.query_cache
+        if other.cache_file == self.cache_file:
+            other.response_cache = self.response_cache
+            other.query_log = self.query_log
+        other._session = self.session
+        return other
+
+    def start_daemon(self):
+        """
+        Runs a daemon that answers queries sent by command_line_runner over a Unix socket,
+        keeping this instance's connections, index handles and caches warm between queries.
+        """
+        if os.path.exists(self.socket_path):
+            if send_to_daemon(self.socket_path, {'ping': True}, timeout=DAEMON_CONNECT_TIMEOUT) is not None:
+                print('A daemon is already listening on %s.' % self.socket_path, file=sys.stderr)
+                sys.exit(1)
+            # Remove the socket left behind by a daemon that didn't shut down cleanly.
+            os.remove(self.socket_path)
+
+        # Warm everything up front, so even the first query is fast.
+        if not self.ignore_local:
+            self.search_backend.ensure_index()
+        if not self.ignore_remote:
+            self.session # pylint: disable=pointless-statement
+
+        howdou = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                request = json.loads(self.rfile.read().decode('utf-8'))
+                response = {}
+                if not request.get('ping'):
+                    try:
+                        # Format with the client's options, such as its output format, rather than the daemon's.
+                        clone = howdou.clone(**request['args'])
+                        answers = clone.run_query(output=False)
+                        if answers is not False or clone.output_format != TEXT:
+                            response['output'] = clone.format_answers(answers or [])
+                    except Exception as e: # pylint: disable=broad-except
+                        traceback.print_exc()
+                        response['error'] = text_type(e)
+                self.wfile.write(json.dumps(response).encode('utf-8'))
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        # Only allow the current user to connect.
+        old_umask = os.umask(0o077)
+        try:
+            server = Server(self.socket_path, Handler)
+        finally:
+            os.umask(old_umask)
+        if threading.current_thread() is threading.main_thread():
+            # Clean up the socket when asked to stop.
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print('Listening on %s...' % self.socket_path)
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
 
     def run_reindex(self):
-        with fasteners.InterProcessLock(self.kb_lockfile_path):
+        with self.kb_lock(shared=False):
             self.index_kb()
 
+    def run_import_dump(self):
+        assert self.query, 'No dump file specified.'
+        with self.kb_lock(shared=False):
+            self.import_dump(os.path.expanduser(self.query))
+
+    def import_dump(self, fn):
+        """
+        Imports the questions in a Stack Exchange Posts.xml dump, each with its top-voted answer, into the local index,
+        so they can be searched without network access.
+
+        The dump is first streamed into a staging database, which is then bulk-loaded into the index.
+        Both steps record checkpoints, so running the import again after an interruption resumes it.
+        """
+        with self.profiler.span('import_dump'):
+            path = os.path.abspath(fn)
+            stat = os.stat(path)
+            signature = '%s:%s' % (stat.st_size, stat.st_mtime)
+            if not self.force and self.manifest.get_meta('import:%s' % path) == signature:
+                print('%s has already been imported.' % path)
+                return
+
+            if not os.path.isdir(self.kb_index_dir):
+                os.makedirs(self.kb_index_dir)
+            staging = DumpStaging(os.path.join(self.kb_index_dir, 'import-%s.sqlite3' % get_text_hash(path)[:16]))
+            if staging.get_meta('signature') not in (None, signature):
+                print('%s changed since it was staged, so starting over.' % path)
+                staging.delete()
+                staging = DumpStaging(staging.filename)
+            staging.set_meta('signature', signature)
+
+            t0 = time.time()
+            if not staging.get_meta('staged'):
+                self.stage_dump(path, staging)
+            count = self.load_dump(path, staging)
+            td = time.time() - t0
+
+            staging.delete()
+            self.manifest.set_meta('import:%s' % path, signature)
+            self.manifest.set_meta('generation', '%f' % time.time())
+            print('\nImported %i answers in %.2f seconds (%.1f docs/sec).' % (count, td, count/td if td else 0))
+
+    def stage_dump(self, fn, staging):
+        """
+        Streams the posts in the dump into the staging database, skipping the rows staged by an earlier run.
+        """
+        from lxml import etree
+        done = int(staging.get_meta('rows') or 0)
+        if done:
+            print('Resuming after %i staged rows.' % done)
+        rows = 0
+        questions = []
+        answers = []
+        for _, row in etree.iterparse(fn, events=('end',), tag='row'):
+            rows += 1
+            if rows > done:
+                post_type = row.get('PostTypeId')
+                if post_type == '1':
+                    questions.append((int(row.get('Id')), row.get('Title'), row.get('Tags') or ''))
+                elif post_type == '2':
+                    score = int(row.get('Score') or 0)
+                    if score >= self.dump_min_score:
+                        answers.append((int(row.get('ParentId')), int(row.get('Id')), score, row.get('Body') or '', row.get('CreationDate')))
+            # Free this row, and the root's references to every earlier row, so memory use stays constant.
+            row.clear()
+            while row.getprevious() is not None:
+                del row.getparent()[0]
+            if rows > done and not rows % DUMP_STAGE_BATCH_SIZE:
+                staging.add(questions, answers, rows)
+                del questions[:]
+                del answers[:]
+                sys.stdout.write('\rStaging row %i...' % rows)
+                sys.stdout.flush()
+        staging.add(questions, answers, max(rows, done))
+        staging.set_meta('staged', 1)
+        print('\rStaged %i rows.' % rows)
+
+    def load_dump(self, fn, staging):
+        """
+        Bulk-loads the staged questions and answers into the index, in the same shape index_kb uses,
+        saving a checkpoint every checkpoint_interval documents. Returns the number of documents loaded.
+        """
+        last_id = int(staging.get_meta('loaded_id') or 0)
+        count = int(staging.get_meta('loaded') or 0)
+        total = staging.count_pairs()
+        if last_id:
+            print('Resuming after %i loaded answers.' % count)
+        while True:
+            pairs = staging.get_pairs(last_id, self.checkpoint_interval)
+            if not pairs:
+                break
+            actions = ({'_op_type': 'index', '_id': _id, '_source': doc} for _id, doc in (self.get_dump_doc(fn, *pair) for pair in pairs))
+            for ok, op_type, _id, error in self.search_backend.bulk(
+                    actions, batch_size=self.index_batch_size, concurrency=self.index_concurrency):
+                if ok:
+                    count += 1
+                    self.profiler.count('docs_indexed')
+                else:
+                    self.profiler.count('docs_failed')
+                    print('\nError on %s of %s: %s' % (op_type, _id, error), file=sys.stderr)
+            # Only record the checkpoint once everything before it is saved.
+            self.search_backend.refresh()
+            last_id = pairs[-1][0]
+            with staging.connection:
+                staging.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('loaded_id', last_id))
+                staging.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('loaded', count))
+            sys.stdout.write('\rLoaded %i of %i answers...' % (count, total))
+            sys.stdout.flush()
+        return count
+
+    def get_dump_doc(self, fn, question_id, title, tags, score, body, created):
+        """
+        Returns the id and index document for a staged question and answer.
+        """
+        from lxml import html as lxml_html
+        from pyquery import PyQuery as pq
+        tags = re.findall(r'[^<>|]+', tags or '')
+        answer = pq(lxml_html.fragment_fromstring(body or '<p></p>', create_parent='div')).text()
+        try:
+            dt = datetime.datetime.strptime(created, '%Y-%m-%dT%H:%M:%S.%f')
+        except (TypeError, ValueError):
+            dt = None
+        text = title + ' ' + answer
+        formatter = next((tag for tag in tags if get_lexer(tag)), None)
+        doc = dict(
+            questions=title,
+            answer=answer,
+            source='%s/questions/%i' % (self.dump_site.rstrip('/'), question_id),
+            filename=fn,
+            text=text,
+            action_subject=None,
+            timestamp=dt,
+            # Scale the vote score down, so a few very popular answers don't drown out closer matches.
+            weight=1 + math.log10(1 + max(score, 0)),
+            formatter=formatter,
+        )
+        if self.prerender:
+            doc['highlighted'] = highlight_code(answer, [formatter] if formatter else [])
+        return get_text_hash(text), doc
+
+    @contextmanager
+    def kb_lock(self, shared=True):
+        """
+        Holds the inter-process lock protecting the index, either shared, for readers,
+        or exclusive, for writers.
+        """
+        lock = get_process_lock(self.kb_lockfile_path)
+        t0 = time.time()
+        with (lock.read_lock() if shared else lock.write_lock()):
+            self.profiler.add_span('lock_wait', time.time() - t0)
+            self.vprint('Waited %.3f seconds for the %s lock.' % (time.time() - t0, 'shared' if shared else 'exclusive'))
+            yield
+
     def run_summarize_field(self):
         """
         Iterates over all knowledgebase items and counts the values associated with the given field path.
@@ -718,7 +3034,7 @@ class HowDoU():
         assert path, 'No query path specified.'
         self.vprint('Searching path:', path)
         self.vprint('Target:', target)
-        data = []
+        found = False
         for item in self.iter_kb():
             value = str(get_nested_key(item, path))
             if value != target:
@@ -729,14 +3045,65 @@ class HowDoU():
                     answer['text'] = re.sub(r'\n[\t\s]+\n', '\n\n', answer['text'], flags=re.M)
                     answer['text'] = re.sub(r'(?<=[^\n\t\s])[ ]+(?=$)', '', answer['text'], flags=re.M)
                     answer['text'] = answer['text'].strip() + '\n\n'
-            data.append(item)
-        yaml.dump(data, stream=sys.stdout, default_flow_style=False, indent=4)
+            # Print each match as it's found, which together form a single list.
+            found = True
+            get_yaml().dump([item], stream=sys.stdout, default_flow_style=False, indent=4)
+        if not found:
+            get_yaml().dump([], stream=sys.stdout, default_flow_style=False, indent=4)
+
+    @contextmanager
+    def profiling(self):
+        """
+        Profiles everything run inside the block, according to the profile options,
+        and then writes the timing report, along with any cProfile and tracemalloc results.
+        """
+        if not self.profiler.enabled:
+            yield
+            return
+        self.profiler.reset()
+        profile = None
+        if self.cprofile_file:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+        if self.tracemalloc:
+            import tracemalloc
+            tracemalloc.start()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                profile.dump_stats(self.cprofile_file)
+            report = self.profiler.report()
+            if self.tracemalloc:
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                report['memory'] = OrderedDict([
+                    ('current_bytes', current),
+                    ('peak_bytes', peak),
+                    ('top', [OrderedDict([
+                        ('location', text_type(stat.traceback)),
+                        ('size_bytes', stat.size),
+                        ('count', stat.count),
+                    ]) for stat in snapshot.statistics('lineno')[:10]]),
+                ])
+            data = json.dumps(report, indent=4)
+            if self.profile_file:
+                with io.open(self.profile_file, 'w', encoding='utf-8') as fout:
+                    fout.write(data + u'\n')
+            else:
+                print(data, file=sys.stderr)
 
     def run(self):
-        run_func = 'run_%s' % self.action.replace('-', '_')
-        if hasattr(self, run_func):
-            return getattr(self, run_func)()
-        raise AttributeError('Invalid action: %s' % self.action)
+        with self.profiling():
+            if self.action == QUERY and self.batch:
+                return self.run_batch()
+            run_func = 'run_%s' % self.action.replace('-', '_')
+            if hasattr(self, run_func):
+                return getattr(self, run_func)()
+            raise AttributeError('Invalid action: %s' % self.action)
 
 
 def get_parser():
@@ -762,9 +3129,23 @@ def get_parser():
         '--kb-index-name',
         help='The knowledge base index name to register in Elasticsearch',
         default=KNOWLEDGEBASE_INDEX)
+    parser.add_argument(
+        '--backend',
+        help='The search engine used for the local knowledge base. One of %s. Default is %s.' \
+            % ('|'.join(sorted(BACKENDS)), DEFAULT_BACKEND),
+        default=DEFAULT_BACKEND)
+    parser.add_argument(
+        '--es-hosts',
+        help='Comma-separated list of Elasticsearch hosts. Default is localhost:9200.',
+        default=ES_HOSTS)
+    parser.add_argument(
+        '--es-timeout',
+        help='Seconds to wait for a response from Elasticsearch. Default is %s.' % ES_TIMEOUT,
+        default=ES_TIMEOUT, type=float)
     parser.add_argument(
         '--kb-timestamp',
-        help='The filename to use to tracking timestamps.',
+        help='The filename to use to tracking timestamps. Each backend and index name gets its own file, '
+            'named by adding them to the end of this one.',
         default=KNOWLEDGEBASE_TIMESTAMP_FN)
     parser.add_argument(
         '--kb-app-dir',
@@ -778,11 +3159,35 @@ def get_parser():
         '--cache-dir',
         help='The filename to use when caching web requests.',
         default=CACHE_DIR)
+    parser.add_argument(
+        '--jobs',
+        help='The number of processes used to parse included knowledge base files. Default is the number of CPUs.',
+        default=os.cpu_count() or 1, type=int)
     parser.add_argument(
         '--lang',
         help='The localization to use. Default is %s.' % LOCALIZATION,
         default=LOCALIZATION)
 
+    parser.add_argument(
+        '--serve',
+        help='Runs a daemon that keeps everything warm and answers queries forwarded by other invocations.',
+        default=False,
+        action='store_true')
+    parser.add_argument(
+        '--socket-path',
+        help='The Unix socket the daemon listens on. Default is %s.' % SOCKET_PATH,
+        default=SOCKET_PATH)
+    parser.add_argument(
+        '--daemon-timeout',
+        help='Seconds to wait for the daemon to answer a query before running it in this process instead. '
+            'Zero waits indefinitely. Default is long enough for every remote request to time out on each retry.',
+        default=DAEMON_TIMEOUT, type=float)
+    parser.add_argument(
+        '--no-daemon',
+        help='Runs the query in this process even if a daemon is running.',
+        default=False,
+        action='store_true')
+
     # This controls the core behavior initiated from the command line.
     parser.add_argument(
         '--action',
@@ -810,6 +3215,43 @@ def get_parser():
         '-n', '--num-answers',
         help='number of answers to return',
         default=1, type=int)
+    parser.add_argument(
+        '--max-workers',
+        help='The maximum number of remote answers fetched in parallel. Default is %s.' % MAX_WORKERS,
+        default=MAX_WORKERS, type=int)
+    parser.add_argument(
+        '--format',
+        help='How answers are printed. One of %s. Default is %s.' % (', '.join(FORMATS), OUTPUT_FORMAT),
+        dest='output_format',
+        default=OUTPUT_FORMAT,
+        choices=FORMATS)
+    parser.add_argument(
+        '--batch',
+        help='Answers each question in the given file, one per line, or in standard input if "-".',
+        default=None)
+    parser.add_argument(
+        '--batch-workers',
+        help='Used with --batch, the number of questions answered in parallel. Default is %s.' % BATCH_WORKERS,
+        default=BATCH_WORKERS, type=int)
+    parser.add_argument(
+        '--disable-query-log',
+        help='Disables counting the questions searched for online, which the warm action uses to pick what to fetch.',
+        default=DISABLE_QUERY_LOG,
+        action='store_true')
+    parser.add_argument(
+        '--warm-limit',
+        help='Used with the warm action, the number of most frequently asked questions to fetch. Default is %s.' \
+            % WARM_LIMIT,
+        default=WARM_LIMIT, type=int)
+    parser.add_argument(
+        '--warm-workers',
+        help='Used with the warm action, the number of web requests made in parallel. Default is %s.' % WARM_WORKERS,
+        default=WARM_WORKERS, type=int)
+    parser.add_argument(
+        '--detach',
+        help='Used with the warm action, runs it in a background process, logging to warm.log in the cache directory.',
+        default=False,
+        action='store_true')
     parser.add_argument(
         '--min-score',
         help='the minimum score accepted on local answers',
@@ -835,11 +3277,67 @@ def get_parser():
         dest='show_source',
         default=True,
         action='store_false')
-    # parser.add_argument(
-        # '--disable-cache',
-        # help='Disables cache of web requests.',
-        # default=bool(os.getenv('HOWDOU_DISABLE_CACHE')),
-        # action='store_true')
+    parser.add_argument(
+        '--disable-cache',
+        help='Disables cache of web requests.',
+        default=DISABLE_CACHE,
+        action='store_true')
+    parser.add_argument(
+        '--cache-ttl',
+        help='The number of seconds a cached web request is kept. Default is %i.' % CACHE_TTL,
+        default=CACHE_TTL, type=float)
+    parser.add_argument(
+        '--connect-timeout',
+        help='Seconds to wait when connecting to a remote site. Default is %s.' % CONNECT_TIMEOUT,
+        default=CONNECT_TIMEOUT, type=float)
+    parser.add_argument(
+        '--read-timeout',
+        help='Seconds to wait for a remote site to respond. Default is %s.' % READ_TIMEOUT,
+        default=READ_TIMEOUT, type=float)
+    parser.add_argument(
+        '--retries',
+        help='How many times to retry a failed remote request, with exponential backoff. Default is %s.' % RETRIES,
+        default=RETRIES, type=int)
+    parser.add_argument(
+        '--cache-max-size',
+        help='The maximum size of the web request cache, in megabytes. Default is %s.' % CACHE_MAX_SIZE,
+        default=CACHE_MAX_SIZE, type=float)
+
+    # Profiling options.
+    parser.add_argument(
+        '--profile',
+        help='Prints a JSON report of the time spent in each phase, like searching and fetching, to stderr.',
+        default=False,
+        action='store_true')
+    parser.add_argument(
+        '--profile-file',
+        help='Writes the --profile report to the given file instead of stderr.',
+        default=None)
+    parser.add_argument(
+        '--cprofile-file',
+        help='Runs under cProfile and saves the statistics to the given file, for use with pstats or snakeviz.',
+        default=None)
+    parser.add_argument(
+        '--tracemalloc',
+        help='Adds the peak memory use and the top allocation sites to the --profile report.',
+        default=False,
+        action='store_true')
+
+    # Import dump action options.
+    parser.add_argument(
+        '--dump-site',
+        help='Used with the import-dump action, the address of the site the dump is from, used to link to each question. '
+            'Default is %s.' % DUMP_SITE,
+        default=DUMP_SITE)
+    parser.add_argument(
+        '--dump-min-score',
+        help='Used with the import-dump action, the lowest vote score an imported answer can have. Default is 0.',
+        default=0, type=int)
+    parser.add_argument(
+        '--checkpoint-interval',
+        help='Used with the import-dump action, the number of documents loaded between checkpoints. Default is %i.' \
+            % DUMP_CHECKPOINT_INTERVAL,
+        default=DUMP_CHECKPOINT_INTERVAL, type=int)
 
     # Reindex action options.
     parser.add_argument(
@@ -847,15 +3345,111 @@ def get_parser():
         help='Used with the reindex option, forces reindexing of all items even if no change was made',
         default=False,
         action='store_true')
+    parser.add_argument(
+        '--prerender',
+        help='Used with the reindex option, stores the colorized text of each answer so -c adds no query time.',
+        default=PRERENDER,
+        action='store_true')
+    parser.add_argument(
+        '--index-batch-size',
+        help='Used with the reindex option, the number of documents sent per bulk request. Default is 500.',
+        default=500, type=int)
+    parser.add_argument(
+        '--index-concurrency',
+        help='Used with the reindex option, the number of bulk requests sent in parallel. Default is 1.',
+        default=1, type=int)
 
     return parser
 
 
+def print_unicode(output_str):
+    try:
+        # Try to print unicode.
+        print(output_str)
+    except UnicodeEncodeError:
+        # If the console forces us to use ASCII, then force ASCII.
+        print(output_str.encode('ascii', 'replace'))
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of the given values, using the nearest-rank method.
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = int(math.ceil(p / 100. * len(values)))
+    return values[max(rank, 1) - 1]
+
+def send_to_daemon(socket_path, request, timeout=None, connect_timeout=DAEMON_CONNECT_TIMEOUT):
+    """
+    Sends a request to the daemon listening on the given socket and returns its response,
+    or None if no daemon could be reached, or it didn't respond within the timeout.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(connect_timeout)
+        client.connect(socket_path)
+        client.settimeout(timeout)
+        client.sendall(json.dumps(request).encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return json.loads(b''.join(chunks).decode('utf-8'))
+    except (socket.error, ValueError):
+        return None
+    finally:
+        client.close()
+
+def get_daemon_timeout(args):
+    """
+    Returns the seconds a daemon is given to answer the query in the given arguments before it's assumed stuck.
+
+    Unless set, this is long enough for the web search, and then the answer pages it links to, to each time out
+    on every retry, so a slow but working daemon isn't given up on just to run the same requests again.
+    """
+    if args['daemon_timeout'] is not None:
+        return args['daemon_timeout'] or None
+    timeout = DAEMON_TIMEOUT_MARGIN
+    if not args['ignore_remote']:
+        backoff = sum(RETRY_BACKOFF_FACTOR * 2**i for i in range(args['retries']))
+        timeout += 2 * ((args['connect_timeout'] + args['read_timeout']) * (args['retries'] + 1) + backoff)
+    return timeout
+
+def get_forwarded_args(args):
+    """
+    Returns the arguments to send to the daemon, with paths made absolute, since it resolves them from its own directory.
+    """
+    args = dict(args)
+    for name in ('kb_filename', 'kb_timestamp', 'kb_app_dir', 'kb_lockfile_path', 'cache_dir'):
+        if args[name]:
+            args[name] = os.path.abspath(os.path.expanduser(args[name]))
+    return args
+
 def command_line_runner():
     parser = get_parser()
     args = vars(parser.parse_args())
+
+    # Forward queries to a running daemon, which has everything warmed up, falling back to running them ourselves.
+    profile = args['profile'] or args['profile_file'] or args['cprofile_file'] or args['tracemalloc']
+    if args['action'] == QUERY and not args['batch'] and not profile and not args['serve'] and not args['no_daemon'] \
+            and os.path.exists(args['socket_path']):
+        response = send_to_daemon(args['socket_path'], {'args': get_forwarded_args(args)}, timeout=get_daemon_timeout(args))
+        if response is not None and 'error' not in response:
+            if 'output' in response and args['output_format'] == TEXT:
+                print_unicode(response['output'])
+            elif 'output' in response:
+                sys.stdout.write(response['output'])
+            return
+
     howdou = HowDoU(**args)
-    howdou.run()
+    if args['serve']:
+        howdou.start_daemon()
+    else:
+        howdou.run()
 
 if __name__ == '__main__':
     command_line_runner()
@@ -4,9 +4,20 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import copy
+import io
+import json
 import os
+import re
 import sys
+import threading
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
 import unittest
+from contextlib import contextmanager
 from unittest import TestCase as _TestCase
 from time import sleep
 from random import randint
@@ -15,6 +26,7 @@ import traceback
 
 import yaml
 
+from . import benchmarks
 from . import howdou
 from .howdou import HowDoU, get_parser
 
@@ -46,6 +58,31 @@ def _getattribute(cls, self, attrname):
 
     return attr
 
+def get_temp_args(tmp_dir):
+    """
+    Returns command line arguments that keep all persistent data files inside the given directory.
+    """
+    return [
+        '--kb-filename=%s' % os.path.join(tmp_dir, 'howdou.yml'),
+        '--kb-timestamp=%s' % os.path.join(tmp_dir, 'howdou_last'),
+        '--kb-app-dir=%s' % os.path.join(tmp_dir, 'app'),
+        '--kb-lockfile-path=%s' % os.path.join(tmp_dir, 'lock'),
+        '--cache-dir=%s' % os.path.join(tmp_dir, 'cache'),
+    ]
+
+@contextmanager
+def captured(name='stdout'):
+    """
+    Replaces sys.stdout, or the named stream, with a StringIO until the block ends, yielding it so the output can be checked.
+    """
+    stream = io.StringIO()
+    original = getattr(sys, name)
+    setattr(sys, name, stream)
+    try:
+        yield stream
+    finally:
+        setattr(sys, name, original)
+
 class TestCase(_TestCase):
 
     test_name_fout = sys.stderr
@@ -61,6 +98,19 @@ class TestCase(_TestCase):
         print(self.test_name_format.format(**kwargs), file=self.test_name_fout)
         super(TestCase, self).setUp()
 
+class TempDirTestCase(TestCase):
+    """
+    Gives each test its own temporary directory, for use with get_temp_args, removed after the test.
+    """
+
+    def setUp(self):
+        super(TempDirTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(TempDirTestCase, self).tearDown()
+
 class HowdouTestCase(TestCase):
 
     def call_howdou(self, query):
@@ -283,6 +333,1050 @@ answers:
         self.assertEqual(len(ret), 1)
         self.assertEqual(ret[0]['answer'], '1. open .howdou.yml\n2. find entry\n3. delete entry\n4. that\'s it')
 
+class LocalBackendTestCase(TempDirTestCase):
+    """
+    Tests the embedded search backend, which needs neither Elasticsearch nor network access.
+    """
+
+    def setUp(self):
+        super(LocalBackendTestCase, self).setUp()
+        self.args = vars(get_parser().parse_args([' ', '--backend=local', '--ignore-remote'] + get_temp_args(self.tmp_dir)))
+        self.howdou = HowDoU(**self.args)
+
+    def add_answer(self, question, text, weight=1):
+        self.howdou.add_item(dict(
+            questions=[question],
+            answers=[dict(weight=weight, date='2017-2-1', source='', text=text)],
+        ))
+
+    def test_exact_then_fuzzy(self):
+        self.howdou.init_kb()
+        self.add_answer('how many toads can a pickle tickle', 'twice as many as a canary')
+        self.howdou.reindex()
+        self.assertEqual(self.howdou.last_reindex_count, 2)
+
+        ret = self.howdou.ask(q='how do I create a new howdou knowledge base entry', output=False)
+        self.assertEqual(len(ret), 1)
+        self.assertEqual(ret[0]['answer'], 'nano ~/.howdou.yml\nhowdou --reindex')
+
+        # No entry contains every term, so this falls back to matching any term.
+        ret = self.howdou.ask(q='toads knowledge', output=False)
+        self.assertEqual(len(ret), 1)
+
+        ret = self.howdou.ask(q='zebra', output=False)
+        self.assertEqual(ret, [])
+
+    def test_weight(self):
+        self.add_answer('how to list files', 'ls')
+        self.add_answer('how to list files', 'find .', weight=10)
+        self.howdou.reindex()
+        self.howdou.num_answers = 2
+        ret = self.howdou.ask(q='list files', output=False)
+        self.assertEqual([_['answer'] for _ in ret], ['find .', 'ls'])
+        self.assertAlmostEqual(ret[0]['score'], ret[1]['score'] * 10)
+
+    def test_batch(self):
+        self.add_answer('how to list files', 'ls')
+        self.add_answer('how to copy files', 'cp a b')
+        self.howdou.reindex()
+        self.howdou.batch_workers = 2
+        stream = io.StringIO(u'how to list files\n\n# A comment.\nhow to copy files\nzebra\n')
+        with captured() as stdout, captured('stderr'):
+            stats = self.howdou.run_batch(stream=stream)
+        self.assertEqual(stats['queries'], 3)
+        self.assertEqual(stats['errors'], 0)
+        self.assertTrue(stats['p50'] <= stats['p99'])
+        output = stdout.getvalue()
+        self.assertTrue('=== how to list files ===' in output)
+        self.assertTrue('ls' in output)
+        self.assertTrue('cp a b' in output)
+        self.assertTrue('=== zebra ===\n\nNo answers found.' in output)
+
+    def test_formats(self):
+        self.add_answer('how to list files', 'ls')
+        self.add_answer('how to list files', 'find .', weight=10)
+        self.howdou.reindex()
+        self.howdou.num_answers = 2
+
+        ret = self.howdou.ask(q='list files', output=False)
+        self.assertTrue(isinstance(ret[0], howdou.Answer))
+        self.assertEqual(ret[0].answer, 'find .')
+        self.assertEqual(ret[0]['location'], howdou.LOCAL)
+        self.assertTrue(ret[0].seconds >= 0)
+        self.assertRaises(AttributeError, setattr, ret[0], 'other', 1)
+
+        self.howdou.output_format = howdou.NDJSON
+        lines = self.howdou.format_answers(ret).splitlines()
+        self.assertEqual([json.loads(line)['answer'] for line in lines], ['find .', 'ls'])
+
+        self.howdou.output_format = howdou.JSON
+        self.assertEqual([_['weight'] for _ in json.loads(self.howdou.format_answers(ret))], [10, 1])
+        self.assertEqual(json.loads(self.howdou.format_answers([])), [])
+
+    def test_profile(self):
+        self.howdou.profiler.enabled = True
+        self.howdou.profile_file = os.path.join(self.tmp_dir, 'profile.json')
+        self.add_answer('how to list files', 'ls')
+        with self.howdou.profiling():
+            self.howdou.reindex()
+            self.howdou.ask(q='list files', output=False)
+        with open(self.howdou.profile_file) as fin:
+            report = json.load(fin)
+        for name in ('index_kb', 'iter_kb', 'run_query', 'get_local_answers', 'search', 'lock_wait'):
+            self.assertTrue(name in report['spans'], name)
+        self.assertEqual(report['spans']['run_query']['count'], 1)
+        self.assertEqual(report['counters']['docs_indexed'], 2)
+
+        # Nothing is recorded unless profiling is enabled.
+        self.howdou.profiler.enabled = False
+        self.howdou.profiler.reset()
+        self.howdou.ask(q='list files', output=False)
+        self.assertEqual(self.howdou.profiler.report()['spans'], {})
+
+    def write_kb(self, items):
+        with open(self.howdou.kb_filename, 'w') as fout:
+            # The howdou YAML representer consumes the dictionaries it dumps, so dump a copy.
+            yaml.dump(copy.deepcopy(items), fout, default_flow_style=False, indent=4)
+        # Ensure the change is detected even on filesystems with coarse timestamps.
+        later = os.path.getmtime(self.howdou.kb_index_timestamp) + 1 if os.path.isfile(self.howdou.kb_index_timestamp) else None
+        if later:
+            os.utime(self.howdou.kb_filename, (later, later))
+
+    def test_delta_reindex(self):
+        items = [
+            dict(questions=['how to list files'], answers=[dict(weight=1, date='2017-2-1', text='ls')]),
+            dict(questions=['how to copy files'], answers=[dict(weight=1, date='2017-2-1', text='cp a b')]),
+        ]
+        self.write_kb(items)
+        self.howdou.reindex()
+        self.assertEqual(self.howdou.ask(q='copy files', output=False)[0]['weight'], 1)
+
+        # Only changing the weight should update the existing document in place.
+        items[1]['answers'][0]['weight'] = 3
+        self.write_kb(items)
+        sent = []
+        _bulk = self.howdou.search_backend.bulk
+        def bulk(actions, **kwargs):
+            actions = list(actions)
+            sent.extend(actions)
+            return _bulk(iter(actions), **kwargs)
+        self.howdou.search_backend.bulk = bulk
+        self.howdou.reindex()
+        self.assertEqual([(_['_op_type'], _['_source']) for _ in sent], [('update', {'doc': {'weight': 3.0}})])
+        self.assertEqual(self.howdou.ask(q='copy files', output=False)[0]['weight'], 3)
+
+        # Fields missing from the new document can only be removed by replacing the old one.
+        self.howdou.prerender = True
+        self.howdou.force = True
+        self.howdou.reindex()
+        self.howdou.prerender = self.howdou.force = False
+        del sent[:]
+        self.write_kb(items)
+        self.howdou.reindex()
+        self.assertEqual(sorted(_['_op_type'] for _ in sent), ['index', 'index'])
+        self.assertFalse(any('highlighted' in _['_source'] for _ in sent))
+
+        # Removing an entry should delete its document.
+        del sent[:]
+        self.write_kb(items[1:])
+        self.howdou.reindex()
+        self.assertEqual([_['_op_type'] for _ in sent], ['delete'])
+        self.assertEqual(self.howdou.ask(q='list', output=False), [])
+
+    def test_force_progress(self):
+        self.add_answer('how to list files', 'ls')
+        self.howdou.reindex()
+        # Even a forced reindex, which starts from scratch, estimates its progress from the last run.
+        self.howdou.force = True
+        with captured() as out:
+            self.howdou.reindex()
+        self.assertTrue('Re-indexing 1 of ~2...' in out.getvalue())
+
+    def test_unchanged_files(self):
+        include_fn = os.path.join(self.tmp_dir, 'include.yml')
+        items = [
+            dict(questions=['how to list files'], answers=[dict(weight=1, date='2017-2-1', text='ls')]),
+            dict(questions=['how to copy files'], answers=[dict(weight=1, date='2017-2-1', text='cp a b')]),
+        ]
+        self.write_kb(items + [dict(include=include_fn)])
+        with open(include_fn, 'w') as fout:
+            yaml.dump([dict(questions=['how to move files'], answers=[dict(weight=1, date='2017-2-1', text='mv a b')])], fout)
+        self.howdou.reindex()
+
+        # Only the changed answer in the changed file is built into a document, and the other file isn't read.
+        items[1]['answers'][0]['text'] = 'cp -r a b'
+        self.write_kb(items + [dict(include=include_fn)])
+        dates = []
+        parse_date = howdou.parse_date
+        def counted_parse_date(value):
+            dates.append(value)
+            return parse_date(value)
+        howdou.parse_date = counted_parse_date
+        try:
+            with captured() as out:
+                self.howdou.reindex()
+        finally:
+            howdou.parse_date = parse_date
+        self.assertEqual(len(dates), 1)
+        self.assertTrue('Re-indexed 3 items, skipping 1 unchanged files.' in out.getvalue())
+        self.assertTrue('Found 1 added, 0 changed and 1 removed documents.' in out.getvalue())
+        self.assertEqual(self.howdou.ask(q='move files', output=False)[0]['answer'], 'mv a b')
+        self.assertEqual(self.howdou.ask(q='copy files', output=False)[0]['answer'], 'cp -r a b')
+
+    def test_invalid_entry(self):
+        items = [
+            dict(questions=['alpha'], answers=[dict(weight=1, date='2017-2-1', text='first')]),
+            dict(questions=['beta'], answers=[dict(weight=1, date='2017-2-1', text='second')]),
+        ]
+        self.write_kb(items)
+        self.howdou.reindex()
+
+        # A stray string between entries is skipped, without losing the entries after it.
+        self.write_kb(items[:1] + ['some string'] + items[1:])
+        invalid = []
+        self.assertEqual(len(list(self.howdou.iter_kb(invalid=invalid))), 2)
+        self.assertEqual(invalid, [(self.howdou.kb_filename, 'some string')])
+
+        # While an entry is invalid, nothing indexed is removed, since it might have been that entry.
+        self.write_kb(['some string'] + items[1:])
+        self.howdou.reindex()
+        self.assertEqual(len(self.howdou.ask(q='alpha', output=False)), 1)
+        self.assertEqual(len(self.howdou.ask(q='beta', output=False)), 1)
+
+    def test_includes(self):
+        a_fn = os.path.join(self.tmp_dir, 'a.yml')
+        b_fn = os.path.join(self.tmp_dir, 'b.yml')
+        def entry(question):
+            return dict(questions=[question], answers=[dict(weight=1, date='2017-2-1', text=question)])
+        self.write_kb([entry('root'), dict(include=a_fn), dict(include=b_fn), dict(include=a_fn)])
+        with open(a_fn, 'w') as fout:
+            # Include the root file to form a cycle.
+            yaml.dump([entry('a'), dict(include=self.howdou.kb_filename)], fout)
+        with open(b_fn, 'w') as fout:
+            yaml.dump([dict(include=a_fn), entry('b')], fout)
+        for jobs in (1, 2):
+            self.howdou.jobs = jobs
+            # Notes about skipped includes mustn't mix with entries printed to stdout, like by filter-by-field.
+            with captured() as out:
+                items = list(self.howdou.iter_kb())
+            self.assertEqual(out.getvalue(), '')
+            self.assertEqual([_['questions'][0] for _ in items], ['root', 'a', 'b'])
+            self.assertEqual([_['filename'] for _ in items], [self.howdou.kb_filename, a_fn, b_fn])
+
+    def test_only_filenames(self):
+        a_fn = os.path.join(self.tmp_dir, 'a.yml')
+        b_fn = os.path.join(self.tmp_dir, 'b.yml')
+        c_fn = os.path.join(self.tmp_dir, 'c.yml')
+        entry = dict(questions=['how to list files'], answers=[dict(weight=1, date='2017-2-1', text='ls')])
+        self.write_kb([entry, dict(include=a_fn), dict(include=b_fn)])
+        with open(a_fn, 'w') as fout:
+            yaml.dump([copy.deepcopy(entry), dict(include=c_fn), dict(include=b_fn)], fout)
+        for fn in (b_fn, c_fn):
+            with open(fn, 'w') as fout:
+                yaml.dump([copy.deepcopy(entry)], fout)
+        # Only file names are listed, nested includes among them, and each only once.
+        self.assertEqual(list(self.howdou.iter_kb(only_filenames=True)), [self.howdou.kb_filename, a_fn, c_fn, b_fn])
+
+        self.howdou.reindex()
+        self.assertFalse(self.howdou.is_kb_updated())
+        later = os.path.getmtime(self.howdou.kb_index_timestamp) + 1
+        os.utime(c_fn, (later, later))
+        self.assertTrue(self.howdou.is_kb_updated())
+
+    def test_prefetch_includes_only(self):
+        submitted = []
+        class Executor(howdou.ProcessPoolExecutor):
+            def submit(self, fn, *args, **kwargs):
+                submitted.append(args[0])
+                return super(Executor, self).submit(fn, *args, **kwargs)
+        ProcessPoolExecutor, howdou.ProcessPoolExecutor = howdou.ProcessPoolExecutor, Executor
+        try:
+            self.howdou.jobs = 2
+            self.write_kb([dict(questions=['how to list files'], answers=[dict(weight=1, date='2017-2-1', text='ls')])])
+            self.assertEqual(len(list(self.howdou.iter_kb())), 1)
+            # There's nothing to parse in the background, so no pool is started.
+            self.assertEqual(submitted, [])
+
+            include_fn = os.path.join(self.tmp_dir, 'include.yml')
+            with open(include_fn, 'w') as fout:
+                yaml.dump([dict(questions=['how to copy files'], answers=[dict(weight=1, date='2017-2-1', text='cp')])], fout)
+            self.write_kb([dict(include=include_fn)])
+            self.assertEqual(len(list(self.howdou.iter_kb())), 1)
+            # The root file is read in the foreground, not parsed again by the pool.
+            self.assertEqual(submitted, [include_fn])
+        finally:
+            howdou.ProcessPoolExecutor = ProcessPoolExecutor
+
+    def test_prefetch_streaming(self):
+        include_fn = os.path.join(self.tmp_dir, 'include.yml')
+        with open(include_fn, 'w') as fout:
+            yaml.dump([dict(questions=['how to copy files'], answers=[dict(weight=1, date='2017-2-1', text='cp')])], fout)
+        self.write_kb([
+            dict(questions=['how to list files'], answers=[dict(weight=1, date='2017-2-1', text='ls')]),
+            dict(include=include_fn),
+        ])
+
+        # The first entry is yielded before the rest of the file is read, so the file's parse cache isn't written yet.
+        self.howdou.jobs = 1
+        items = self.howdou.iter_kb()
+        self.assertEqual(next(items)['questions'], ['how to list files'])
+        self.assertEqual(howdou.get_parse_cache_header(self.howdou.kb_filename, self.howdou.kb_parse_cache_dir), {})
+        items.close()
+
+        # With more than one job, the root file is first streamed into its parse cache to find the files it includes.
+        self.howdou.jobs = 2
+        items = self.howdou.iter_kb()
+        self.assertEqual(next(items)['questions'], ['how to list files'])
+        header = howdou.get_parse_cache_header(self.howdou.kb_filename, self.howdou.kb_parse_cache_dir)
+        self.assertEqual(header['includes'], [include_fn])
+        items.close()
+        self.assertEqual(len(list(self.howdou.iter_kb())), 2)
+
+    def test_prefetch_concurrent(self):
+        # Every file included by the root is parsed at the same time, or the barrier gives up on them.
+        fns = [os.path.join(self.tmp_dir, 'include%i.yml' % i) for i in range(3)]
+        for i, fn in enumerate(fns):
+            with open(fn, 'w') as fout:
+                yaml.dump([dict(questions=['question %i' % i], answers=[dict(weight=1, date='2017-2-1', text='%i' % i)])], fout)
+        self.write_kb([dict(include=fn) for fn in fns])
+        barrier = threading.Barrier(len(fns), timeout=10)
+        passed = []
+        get_kb_includes = howdou.get_kb_includes
+        def concurrent_get_kb_includes(fn, cache_dir=None):
+            if fn in fns:
+                barrier.wait()
+                passed.append(fn)
+            return get_kb_includes(fn, cache_dir=cache_dir)
+        # Threads, unlike processes, see the patched function.
+        ProcessPoolExecutor, howdou.ProcessPoolExecutor = howdou.ProcessPoolExecutor, howdou.ThreadPoolExecutor
+        howdou.get_kb_includes = concurrent_get_kb_includes
+        try:
+            self.howdou.jobs = len(fns)
+            items = list(self.howdou.iter_kb())
+        finally:
+            howdou.ProcessPoolExecutor = ProcessPoolExecutor
+            howdou.get_kb_includes = get_kb_includes
+        self.assertEqual(sorted(passed), sorted(fns))
+        # The entries are still read in order.
+        self.assertEqual([_['questions'][0] for _ in items], ['question 0', 'question 1', 'question 2'])
+
+    def test_query_cache(self):
+        self.howdou.init_kb()
+        self.howdou.reindex()
+        q = 'how do I create a new howdou knowledge base entry'
+        first = self.howdou.ask(q=q, output=False)
+        self.assertEqual(self.howdou.ask(q=q, output=False), first)
+        self.assertEqual(self.howdou.query_cache_stats, dict(memory_hits=1, disk_hits=0, misses=1))
+
+        other = HowDoU(**self.args)
+        self.assertEqual(other.ask(q=q, output=False), first)
+        self.assertEqual(other.query_cache_stats, dict(memory_hits=0, disk_hits=1, misses=0))
+
+        # Reindexing a change must invalidate the cached results.
+        self.add_answer(q, 'copy another entry', weight=100)
+        self.howdou.reindex()
+        self.assertEqual(other.ask(q=q, output=False)[0]['answer'], 'copy another entry')
+        self.assertEqual(other.query_cache_stats['misses'], 1)
+
+        # Another index sharing the app directory doesn't use these results.
+        other = HowDoU(**dict(self.args, kb_index_name='other'))
+        other.search_local_answers = lambda query: []
+        self.assertEqual(other.ask(q=q, output=False), [])
+
+    def test_color(self):
+        self.howdou.add_item(dict(
+            questions=['how to print the date'],
+            answers=[dict(date='2017-2-1', formatter='bash', text='echo $(date +%Y-%m-%d)')],
+        ))
+        self.howdou.prerender = True
+        self.howdou.reindex()
+        highlighted = [_ for _ in self.howdou.search_backend.data['docs'].values() if _['formatter'] == 'bash'][0]['highlighted']
+        self.assertTrue('\x1b[' in highlighted)
+
+        self.howdou.color = True
+        self.assertEqual(self.howdou.ask(q='print date', output=False)[0]['answer'], highlighted.strip())
+        self.howdou.color = False
+        self.assertEqual(self.howdou.ask(q='print date', output=False)[0]['answer'], 'echo $(date +%Y-%m-%d)')
+
+    def test_get_lexer(self):
+        self.assertEqual(howdou.get_lexer('Python').name, 'Python')
+        self.assertEqual(howdou.get_lexer('nl'), None)
+        self.assertTrue('nl' in howdou._lexers)
+
+    def test_separate_indexes(self):
+        self.howdou.init_kb()
+        self.howdou.reindex()
+        q = 'new howdou knowledge base entry'
+
+        # Another index sharing the app directory is still indexed from scratch.
+        other = HowDoU(**dict(self.args, kb_index_name='other'))
+        other.reindex()
+        self.assertEqual(other.last_reindex_count, 1)
+        self.assertEqual(len(other.ask(q=q, output=False)), 1)
+
+        # Forcibly reindexing one index leaves the other alone.
+        other.force = True
+        other.reindex()
+        self.assertTrue(os.path.isfile(self.howdou.search_backend.index_filename))
+        self.assertEqual(len(HowDoU(**self.args).ask(q=q, output=False)), 1)
+
+    def test_persisted(self):
+        self.howdou.init_kb()
+        self.howdou.reindex()
+        other = HowDoU(**self.args)
+        ret = other.ask(q='new howdou knowledge base entry', output=False)
+        self.assertEqual(len(ret), 1)
+
+class ElasticsearchBackendTestCase(TempDirTestCase):
+    """
+    Tests the Elasticsearch backend against the in-memory client used by the benchmarks.
+    """
+
+    def test_create_on_missing_index(self):
+        hdu = benchmarks.get_howdou(self.tmp_dir, howdou.ElasticsearchBackend.name)
+        client = hdu.search_backend.client
+        created = []
+        create = client.indices.create
+        def counted_create(index, **kwargs):
+            created.append(index)
+            return create(index, **kwargs)
+        client.indices.create = counted_create
+
+        # The index is created once a search finds it missing.
+        self.assertEqual(hdu.search_local_answers('list files'), [])
+        self.assertEqual(created, [hdu.kb_index_name])
+
+        # Queries made by new instances don't check for the index again.
+        other = benchmarks.get_howdou(self.tmp_dir, howdou.ElasticsearchBackend.name)
+        other.search_backend._client = client # pylint: disable=protected-access
+        self.assertEqual(other.search_local_answers('list files'), [])
+        self.assertEqual(created, [hdu.kb_index_name])
+
+class ImportDumpTestCase(TempDirTestCase):
+    """
+    Tests importing a Stack Exchange Posts.xml dump into the local index.
+    """
+
+    POSTS = '''<?xml version="1.0" encoding="utf-8"?>
+<posts>
+  <row Id="1" PostTypeId="1" Score="10" Title="How do I reverse a list in Python?" Tags="&lt;python&gt;&lt;list&gt;"
+      CreationDate="2010-01-01T00:00:00.000" />
+  <row Id="2" PostTypeId="2" ParentId="1" Score="3" Body="&lt;p&gt;Use &lt;code&gt;sorted&lt;/code&gt;.&lt;/p&gt;"
+      CreationDate="2010-01-02T00:00:00.000" />
+  <row Id="3" PostTypeId="2" ParentId="1" Score="50" Body="&lt;pre&gt;&lt;code&gt;mylist[::-1]&lt;/code&gt;&lt;/pre&gt;"
+      CreationDate="2010-01-03T00:00:00.000" />
+  <row Id="4" PostTypeId="1" Score="1" Title="How do I count lines in a file?" Tags="&lt;bash&gt;"
+      CreationDate="2011-01-01T00:00:00.000" />
+  <row Id="5" PostTypeId="2" ParentId="4" Score="7" Body="&lt;pre&gt;&lt;code&gt;wc -l file&lt;/code&gt;&lt;/pre&gt;"
+      CreationDate="2011-01-02T00:00:00.000" />
+  <row Id="6" PostTypeId="1" Score="0" Title="An unanswered question" Tags=""
+      CreationDate="2012-01-01T00:00:00.000" />
+  <row Id="7" PostTypeId="1" Score="2" Title="How do I make a temporary directory?" Tags="&lt;python&gt;"
+      CreationDate="2013-01-01T00:00:00.000" />
+  <row Id="8" PostTypeId="2" ParentId="7" Score="-2" Body="&lt;p&gt;mkdir /tmp/x&lt;/p&gt;"
+      CreationDate="2013-01-02T00:00:00.000" />
+</posts>
+'''
+
+    def setUp(self):
+        super(ImportDumpTestCase, self).setUp()
+        self.dump_fn = os.path.join(self.tmp_dir, 'Posts.xml')
+        with open(self.dump_fn, 'w') as fout:
+            fout.write(self.POSTS)
+        self.args = vars(get_parser().parse_args(
+            [self.dump_fn, '--backend=local', '--ignore-remote', '--action=import-dump', '--checkpoint-interval=1']
+            + get_temp_args(self.tmp_dir)))
+
+    def test_import(self):
+        HowDoU(**self.args).run()
+        hdu = HowDoU(**dict(self.args, action='query'))
+        ret = hdu.ask(q='reverse list python', output=False)
+        self.assertEqual(len(ret), 1)
+        # Only the top-voted answer is imported.
+        self.assertEqual(ret[0]['answer'], 'mylist[::-1]')
+        self.assertEqual(ret[0]['source'], 'https://stackoverflow.com/questions/1')
+        self.assertEqual(hdu.ask(q='count lines file', output=False)[0]['answer'], 'wc -l file')
+        # Answers with negative scores and unanswered questions are skipped.
+        self.assertEqual(hdu.ask(q='temporary directory', output=False), [])
+        self.assertEqual(hdu.ask(q='unanswered', output=False), [])
+        # The staging database is removed once the import is finished.
+        self.assertEqual([fn for fn in os.listdir(hdu.kb_index_dir) if fn.startswith('import-')], [])
+
+        # Importing the same dump again does nothing.
+        with captured() as out:
+            HowDoU(**self.args).run()
+        self.assertTrue('already been imported' in out.getvalue())
+
+    def test_resume(self):
+        hdu = HowDoU(**self.args)
+        bulk = hdu.search_backend.bulk
+        calls = []
+        def interrupted_bulk(*args, **kwargs):
+            calls.append(1)
+            if len(calls) > 1:
+                raise KeyboardInterrupt
+            return bulk(*args, **kwargs)
+        hdu.search_backend.bulk = interrupted_bulk
+        self.assertRaises(KeyboardInterrupt, hdu.run)
+
+        hdu = HowDoU(**self.args)
+        bulk = hdu.search_backend.bulk
+        loaded = []
+        def counted_bulk(actions, *args, **kwargs):
+            actions = list(actions)
+            loaded.extend(action['_source']['questions'] for action in actions)
+            return bulk(actions, *args, **kwargs)
+        hdu.search_backend.bulk = counted_bulk
+        hdu.run()
+        # Only the question after the checkpoint is loaded again.
+        self.assertEqual(loaded, ['How do I count lines in a file?'])
+        ret = HowDoU(**dict(self.args, action='query')).ask(q='reverse list python', output=False)
+        self.assertEqual(len(ret), 1)
+
+class KbLockTestCase(TempDirTestCase):
+
+    def setUp(self):
+        super(KbLockTestCase, self).setUp()
+        self.howdou = HowDoU(**vars(get_parser().parse_args([' ', '--backend=local'] + get_temp_args(self.tmp_dir))))
+
+    def try_write_lock(self):
+        """
+        Returns true if another process can take the exclusive lock right now.
+        """
+        return subprocess.check_output(
+            [sys.executable, '-c', 'import sys, fasteners; lock = fasteners.InterProcessReaderWriterLock(sys.argv[1]); '
+             'print(lock.acquire_write_lock(blocking=False))', self.howdou.kb_lockfile_path]).strip() == b'True'
+
+    def test_shared_by_threads(self):
+        with self.howdou.kb_lock(shared=True):
+            # Another thread taking and releasing the shared lock mustn't release it for this one.
+            def read():
+                with self.howdou.kb_lock(shared=True):
+                    pass
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+            self.assertFalse(self.try_write_lock())
+        self.assertTrue(self.try_write_lock())
+
+    def test_exclusive(self):
+        events = []
+        def read():
+            with self.howdou.kb_lock(shared=True):
+                events.append('read')
+        with self.howdou.kb_lock(shared=False):
+            thread = threading.Thread(target=read)
+            thread.start()
+            sleep(0.2)
+            # Readers in this process wait for the writer too, and the writer can take the lock again.
+            with self.howdou.kb_lock(shared=True):
+                events.append('nested')
+            events.append('written')
+        thread.join()
+        self.assertEqual(events, ['nested', 'written', 'read'])
+
+class IndexManifestTestCase(TempDirTestCase):
+
+    def test_batch(self):
+        manifest = howdou.IndexManifest(self.tmp_dir)
+        pairs = [('question %i' % i, 'answer %i' % i) for i in range(1000)]
+        self.assertEqual(manifest.contains_many(pairs), set())
+        manifest.add_many(pairs[::2])
+        self.assertEqual(manifest.contains_many(pairs), set(pairs[::2]))
+        self.assertEqual(manifest.contains_many([('question 0', 'answer 1')]), set())
+        # Pairs already recorded, or repeated, are only recorded once.
+        manifest.add_many(pairs[:4] + pairs[:4])
+        count = manifest.connection.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+        self.assertEqual(count, 502)
+
+    def test_migrate(self):
+        # Older versions wrote one file per question directly in the app directory.
+        app_dir = os.path.join(self.tmp_dir, 'app')
+        os.makedirs(app_dir)
+        legacy_fn = os.path.join(app_dir, howdou.get_text_hash('how do I list files'))
+        with open(legacy_fn, 'w') as fout:
+            fout.write(howdou.get_text_hash('ls'))
+        pairs = [('how do I list files', 'ls')]
+
+        # Those were only ever written for Elasticsearch, so other backends leave them alone.
+        hdu = HowDoU(**vars(get_parser().parse_args([' ', '--backend=local'] + get_temp_args(self.tmp_dir))))
+        self.assertFalse(hdu.manifest.contains_many(pairs))
+        self.assertTrue(os.path.isfile(legacy_fn))
+
+        hdu = HowDoU(**vars(get_parser().parse_args([' ', '--backend=elasticsearch'] + get_temp_args(self.tmp_dir))))
+        self.assertTrue(hdu.manifest.contains_many(pairs))
+        self.assertFalse(os.path.isfile(legacy_fn))
+
+class ParseCacheTestCase(TempDirTestCase):
+
+    def setUp(self):
+        super(ParseCacheTestCase, self).setUp()
+        self.kb_fn = os.path.join(self.tmp_dir, 'howdou.yml')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self._iter_yaml_items = howdou.iter_yaml_items
+        self.parses = []
+        def _iter_yaml_items(*args, **kwargs):
+            self.parses.append(args)
+            return self._iter_yaml_items(*args, **kwargs)
+        howdou.iter_yaml_items = _iter_yaml_items
+
+    def tearDown(self):
+        howdou.iter_yaml_items = self._iter_yaml_items
+        super(ParseCacheTestCase, self).tearDown()
+
+    def test_cache(self):
+        with open(self.kb_fn, 'w') as fout:
+            fout.write(howdou.KNOWLEDGEBASE_STUB)
+        items = howdou.load_kb_file(self.kb_fn, cache_dir=self.cache_dir)
+        self.assertEqual(items[0]['questions'], ['how do I create a new howdou knowledge base entry'])
+        self.assertEqual(len(self.parses), 1)
+
+        self.assertEqual(howdou.load_kb_file(self.kb_fn, cache_dir=self.cache_dir), items)
+        self.assertEqual(len(self.parses), 1)
+
+        # Touching the file without changing it should not require a reparse.
+        os.utime(self.kb_fn, (1, 1))
+        self.assertEqual(howdou.load_kb_file(self.kb_fn, cache_dir=self.cache_dir), items)
+        self.assertEqual(len(self.parses), 1)
+
+        with open(self.kb_fn, 'a') as fout:
+            fout.write('-   include: other.yml\n')
+        items = howdou.load_kb_file(self.kb_fn, cache_dir=self.cache_dir)
+        self.assertEqual(items[-1], {'include': 'other.yml'})
+        self.assertEqual(len(self.parses), 2)
+
+    def test_streaming(self):
+        items = [dict(questions=['question %i' % i], answers=[dict(text='answer %i' % i, date='2017-2-1')]) for i in range(5)]
+        with open(self.kb_fn, 'w') as fout:
+            yaml.dump(copy.deepcopy(items), fout, default_flow_style=False, indent=4)
+
+        # Entries are yielded as they're parsed, and the cache is only kept once all of them have been read.
+        entries = howdou.iter_kb_file(self.kb_fn, cache_dir=self.cache_dir)
+        self.assertEqual(next(entries), items[0])
+        entries.close()
+        self.assertFalse(os.path.isdir(self.cache_dir) and os.listdir(self.cache_dir))
+
+        self.assertEqual(list(howdou.iter_kb_file(self.kb_fn, cache_dir=self.cache_dir)), items)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assertEqual(list(howdou.iter_kb_file(self.kb_fn, cache_dir=self.cache_dir)), items)
+        self.assertEqual(len(self.parses), 2)
+
+        for text in ('', '{}', 'just text'):
+            with open(self.kb_fn, 'w') as fout:
+                fout.write(text)
+            self.assertEqual(list(howdou.iter_kb_file(self.kb_fn)), [])
+
+class ResponseCacheTestCase(TempDirTestCase):
+
+    def setUp(self):
+        super(ResponseCacheTestCase, self).setUp()
+        self.cache_fn = os.path.join(self.tmp_dir, 'cache')
+
+    def test_ttl(self):
+        cache = howdou.ResponseCache(self.cache_fn, max_size=1024*1024, ttl=60)
+        cache.set('a', u'caf\xe9')
+        cache.set('b', u'stale', ttl=-1)
+        self.assertEqual(cache.get('a'), u'caf\xe9')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), None)
+        # Entries expiring too soon are treated as missing, but kept.
+        self.assertEqual(cache.get('a', min_ttl=120), None)
+        self.assertEqual(cache.get('a'), u'caf\xe9')
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+
+    def test_lru(self):
+        value = os.urandom(1000).hex()
+        cache = howdou.ResponseCache(self.cache_fn, max_size=3000, ttl=60)
+        cache.set('a', value)
+        cache.set('b', value)
+        cache.get('a')
+        cache.set('c', value)
+        # The least recently used entry is evicted to make room.
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), value)
+        self.assertEqual(cache.get('c'), value)
+
+    def test_get_result(self):
+        args = vars(get_parser().parse_args([' ', '--cache-dir=%s' % self.tmp_dir]))
+        hdu = HowDoU(**args)
+        urls = []
+        class Response():
+            ok = True
+            status_code = 200
+            text = u'<html></html>'
+        class Session():
+            def get(self, url, **kwargs):
+                urls.append(url)
+                return Response()
+        hdu._session = Session()
+        self.assertEqual(hdu.get_result('https://stackoverflow.com/questions/1/'), Response.text)
+        self.assertEqual(hdu.get_result('https://stackoverflow.com/questions/1/'), Response.text)
+        self.assertEqual(len(urls), 1)
+        hdu.disable_cache = True
+        hdu.get_result('https://stackoverflow.com/questions/1/')
+        self.assertEqual(len(urls), 2)
+
+        # A page that times out is reported, not raised.
+        from requests.exceptions import Timeout
+        class TimeoutSession():
+            def get(self, url, **kwargs):
+                raise Timeout('Read timed out.')
+        hdu._session = TimeoutSession()
+        with captured('stderr') as stderr:
+            self.assertEqual(hdu.get_result('https://stackoverflow.com/questions/2/'), u'')
+        self.assertTrue('Read timed out.' in stderr.getvalue())
+
+        # Error responses still left after retrying are returned rather than raised.
+        hdu._session = None
+        self.assertFalse(hdu.session.get_adapter('https://google.com').max_retries.raise_on_status)
+
+class RemoteAnswersTestCase(TempDirTestCase):
+
+    def setUp(self):
+        super(RemoteAnswersTestCase, self).setUp()
+        self.args = vars(get_parser().parse_args(['format', 'date', 'bash', '--ignore-local'] + get_temp_args(self.tmp_dir)))
+        self.links = [
+            '/url?q=https://stackoverflow.com/questions/1/first&sa=U',
+            '/url?q=https://stackoverflow.com/questions/1/first&sa=U',
+            '/howdou',
+            '/url?q=https://stackoverflow.com/questions/2/second&sa=U',
+            '/url?q=https://stackoverflow.com/questions/3/third&sa=U',
+        ]
+
+    def get_howdou(self, num_answers, barrier=None):
+        hdu = HowDoU(**dict(self.args, num_answers=num_answers))
+        hdu.get_links = lambda query: self.links
+        def get_result(url):
+            if barrier:
+                # Every page must be requested at the same time for the barrier to let them through.
+                barrier.wait()
+            number = re.search(r'questions/(\d+)/', url).group(1)
+            return '<div class="answer"><div class="post-text"><pre>answer %s</pre></div></div>' % number
+        hdu.get_result = get_result
+        return hdu
+
+    def test_distinct_answers(self):
+        hdu = self.get_howdou(3, barrier=threading.Barrier(3, timeout=10))
+        ret = hdu.ask(output=False)
+        self.assertEqual([_['answer'] for _ in ret], ['answer 1', 'answer 2', 'answer 3'])
+        self.assertEqual(ret[1]['source'], self.links[3])
+
+    def test_shared_session(self):
+        hdu = HowDoU(**self.args)
+        get_user_agent = howdou.get_user_agent
+        class UserAgent():
+            random = 'howdou-test'
+        def slow_get_user_agent():
+            # Give other threads a chance to create a session of their own.
+            sleep(0.1)
+            return UserAgent()
+        howdou.get_user_agent = slow_get_user_agent
+        try:
+            sessions = []
+            threads = [threading.Thread(target=lambda: sessions.append(hdu.session)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            howdou.get_user_agent = get_user_agent
+        self.assertEqual(len(sessions), 4)
+        self.assertEqual(len(set(map(id, sessions))), 1)
+
+    def test_no_lock_during_fetch(self):
+        hdu = self.get_howdou(1)
+        # Hold the exclusive lock from another process, as a reindex would.
+        holder = subprocess.Popen(
+            [sys.executable, '-c', 'import sys, fasteners; lock = fasteners.InterProcessReaderWriterLock(sys.argv[1]); '
+             'lock.acquire_write_lock(); print("locked"); sys.stdout.flush(); sys.stdin.read()', hdu.kb_lockfile_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            self.assertEqual(holder.stdout.readline().strip(), b'locked')
+            self.assertEqual([_['answer'] for _ in hdu.ask(output=False)], ['answer 1'])
+        finally:
+            holder.communicate()
+
+    def test_no_links(self):
+        hdu = self.get_howdou(1)
+        self.links = []
+        self.assertEqual(hdu.ask(output=False), False)
+        hdu.output_format = howdou.JSON
+        with captured() as out:
+            ret = hdu.ask()
+        # The JSON formats still write an empty result.
+        self.assertEqual(ret, True)
+        self.assertEqual(json.loads(out.getvalue()), [])
+
+    def test_position(self):
+        hdu = self.get_howdou(1)
+        hdu.pos = 2
+        self.assertEqual([_['answer'] for _ in hdu.ask(output=False)], ['answer 2'])
+        hdu.pos = 10
+        self.assertEqual([_['answer'] for _ in hdu.ask(output=False)], ['answer 3'])
+
+    QUESTION_PAGE = '''<html><head><meta charset="utf-8"><script>var s = "<div class=\\"answer\\">";</script></head><body>
+<div class="question"><div class="post-text"><p>How?</p></div><a class="post-tag">bash</a><a class="post-tag">date</a></div>
+<div id="answer-1" class="answer accepted-answer"><div class="post-text">
+<p>Use <code>date</code> &amp; friends:</p>
+<pre><code>date +%Y-%m-%d</code></pre>
+<ul><li>one</li><li>two</li></ul>
+</div></div>
+<div id="answer-2" class="answer"><div class="post-text"><pre>second answer</pre></div></div>
+<div class="sidebar"><a class="post-tag">python</a></div>
+</body></html>'''
+
+    def test_extract(self):
+        record = howdou.extract_answer(self.QUESTION_PAGE)
+        self.assertEqual(record['tags'], ['bash', 'date'])
+        self.assertEqual(record['code'], 'date +%Y-%m-%d')
+        self.assertEqual(record['post_text'], 'Use date & friends:\ndate +%Y-%m-%d\none\ntwo')
+        self.assertEqual([tag for tag, _ in record['blocks']], ['p', 'pre', 'ul'])
+
+        self.assertEqual(howdou.extract_answer('<html></html>'), dict(tags=[], code=None, post_text='', blocks=[]))
+        record = howdou.extract_answer('<div class="answer"><div class="post-text"><p>Just text.</p></div></div>')
+        self.assertEqual((record['code'], record['post_text']), (None, 'Just text.'))
+
+    def test_modes(self):
+        hdu = self.get_howdou(1)
+        pages = []
+        def get_result(url):
+            pages.append(url)
+            return self.QUESTION_PAGE
+        hdu.get_result = get_result
+        link = self.links[0]
+        self.assertEqual(hdu.get_answer_text(link), ('date +%Y-%m-%d', ['bash', 'date']))
+        hdu.all = True
+        self.assertEqual(hdu.get_answer_text(link)[0], 'Use date & friends:\ndate +%Y-%m-%d\none\ntwo\n\n---\nAnswer from ' + link)
+        hdu.link = True
+        self.assertEqual(hdu.get_answer(self.links, pos=1), (None, self.links[0]))
+
+        # The page was only fetched and parsed once, and its extracted record reused for every mode.
+        self.assertEqual(len(pages), 1)
+        hdu.disable_cache = True
+        hdu.get_answer_text(link)
+        self.assertEqual(len(pages), 2)
+
+class WarmTestCase(TempDirTestCase):
+    """
+    Tests logging the questions searched for online and fetching the most frequent ahead of time.
+    """
+
+    def setUp(self):
+        super(WarmTestCase, self).setUp()
+        self.args = vars(get_parser().parse_args(
+            [' ', '--backend=local', '--ignore-local', '--num-answers=2', '--action=warm'] + get_temp_args(self.tmp_dir)))
+
+    def test_query_log(self):
+        log = howdou.QueryLog(os.path.join(self.tmp_dir, 'queries'))
+        for query in ('list files', 'count lines', 'list files', 'make directory'):
+            log.record(query)
+        self.assertEqual(log.top(2), ['list files', 'make directory'])
+        log.clear()
+        self.assertEqual(log.top(2), [])
+
+    def test_warm(self):
+        hdu = HowDoU(**self.args)
+        with benchmarks.stand_in_web():
+            hdu.ask(q='asked question', output=False)
+            self.assertEqual(hdu.query_log.top(10), ['asked question'])
+
+            # Count the questions without fetching them, so only warming fills the cache.
+            for query in ('popular question', 'popular question', 'rare question'):
+                hdu.query_log.record(query)
+            with benchmarks.quiet():
+                stats = HowDoU(**dict(self.args, warm_limit=1)).run()
+            self.assertEqual((stats['queries'], stats['answers'], stats['errors']), (1, 2, 0))
+
+            hdu = HowDoU(**dict(self.args, action='query', disable_query_log=True))
+            urls = []
+            get = hdu.session.get
+            def counted_get(url, **kwargs):
+                urls.append(url)
+                return get(url, **kwargs)
+            hdu.session.get = counted_get
+            # The warmed question is answered without the network, unlike the one left out.
+            self.assertEqual(len(hdu.ask(q='popular question', output=False)), 2)
+            self.assertEqual(urls, [])
+            hdu.ask(q='rare question', output=False)
+            self.assertEqual(len(urls), 3)
+
+class BenchmarkTestCase(TempDirTestCase):
+    """
+    Runs the benchmarks on a tiny knowledge base, to make sure they keep working.
+    """
+
+    def test_local(self):
+        results = benchmarks.run_benchmarks([30], queries=5, remote_queries=2, startup_runs=0)
+        size = results['sizes']['30']
+        self.assertTrue(size['index_kb_docs_per_second'] > 0)
+        self.assertEqual(size['get_local_answers_cold']['count'], 5)
+        self.assertTrue(size['get_local_answers_cold']['p50'] <= size['get_local_answers_cold']['p99'])
+        self.assertEqual(results['remote_query']['count'], 2)
+        json.dumps(results)
+
+        lines = benchmarks.compare(results, results)
+        self.assertTrue(any('sizes.30.index_kb_seconds' in line and '+0.0%' in line for line in lines))
+
+    def test_elasticsearch(self):
+        results = benchmarks.run_benchmarks([30], backend='elasticsearch', queries=5, remote_queries=0, startup_runs=0)
+        self.assertTrue(results['sizes']['30']['index_kb_docs_per_second'] > 0)
+
+    def test_generate_kb(self):
+        fn, questions = benchmarks.generate_kb(self.tmp_dir, 25, files=3)
+        hdu = benchmarks.get_howdou(self.tmp_dir, 'local', '--kb-filename=%s' % fn)
+        self.assertEqual(len(list(hdu.iter_kb(only_filenames=True))), 4)
+        items = list(hdu.iter_kb())
+        self.assertEqual(len(items), 25)
+        self.assertTrue(set(questions) <= set(item['questions'][0] for item in items))
+
+class StartupTestCase(TempDirTestCase):
+    """
+    Guards against regressions in the fixed cost of running the command line tool.
+    """
+
+    heavy_modules = ['requests', 'yaml', 'dateutil', 'fake_useragent', 'pygments', 'pyquery', 'lxml', 'elasticsearch']
+
+    # Generous, so the test only fails when an expensive import sneaks back in.
+    max_seconds = 2.0
+
+    script = '''
+import sys, time
+t0 = time.time()
+from howdou.howdou import command_line_runner
+sys.argv = ['howdou'] + sys.argv[1:]
+try:
+    command_line_runner()
+except SystemExit:
+    pass
+sys.stderr.write('%f %s' % (time.time() - t0, ','.join(sorted(set(sys.modules) & set(HEAVY)))))
+'''
+
+    def run_howdou(self, *args):
+        script = self.script.replace('HEAVY', repr(self.heavy_modules))
+        process = subprocess.Popen(
+            [sys.executable, '-c', script] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        stdout, stderr = process.communicate()
+        seconds, modules = stderr.decode('utf-8').split('\n')[-1].split(' ', 1)
+        print('%.3f seconds for: howdou %s' % (float(seconds), ' '.join(args)))
+        return stdout.decode('utf-8'), float(seconds), [_ for _ in modules.split(',') if _]
+
+    def test_version(self):
+        stdout, seconds, modules = self.run_howdou('--version')
+        self.assertEqual(stdout.strip(), howdou.__version__)
+        self.assertEqual(modules, [])
+        self.assertLess(seconds, self.max_seconds)
+
+    def test_local_query(self):
+        args = ['--backend=local'] + get_temp_args(self.tmp_dir)
+        hdu = HowDoU(**vars(get_parser().parse_args(['--action=reindex'] + args)))
+        hdu.init_kb()
+        hdu.run()
+        stdout, seconds, modules = self.run_howdou('create', 'knowledge', 'base', 'entry', '--ignore-remote', *args)
+        self.assertTrue('howdou --reindex' in stdout)
+        self.assertEqual(modules, [])
+        self.assertLess(seconds, self.max_seconds)
+
+class DaemonTestCase(TempDirTestCase):
+
+    def setUp(self):
+        super(DaemonTestCase, self).setUp()
+        self.socket_path = os.path.join(self.tmp_dir, 'howdou.sock')
+        self.args = ['--backend=local', '--ignore-remote', '--socket-path=%s' % self.socket_path] + get_temp_args(self.tmp_dir)
+        hdu = HowDoU(**vars(get_parser().parse_args(['--action=reindex'] + self.args)))
+        hdu.init_kb()
+        hdu.run()
+        self.daemon = subprocess.Popen(
+            [sys.executable, '-m', 'howdou.howdou', '--serve'] + self.args,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                break
+            sleep(0.1)
+
+    def tearDown(self):
+        self.daemon.terminate()
+        self.daemon.wait()
+        self.assertFalse(os.path.exists(self.socket_path))
+        super(DaemonTestCase, self).tearDown()
+
+    def test_query(self):
+        args = vars(get_parser().parse_args(['create', 'knowledge', 'base', 'entry'] + self.args))
+        response = howdou.send_to_daemon(self.socket_path, {'args': args})
+        self.assertTrue('howdou --reindex' in response['output'])
+        hdu = HowDoU(**args)
+        self.assertEqual(response['output'], hdu.format_answers(hdu.run_query(output=False)))
+
+    def test_relative_paths(self):
+        # The daemon runs from another directory, so relative paths are made absolute before they're forwarded.
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        try:
+            args = vars(get_parser().parse_args(
+                ['create', 'knowledge', 'base', 'entry', '--kb-filename=howdou.yml', '--kb-app-dir=app'] + self.args[:3]))
+            forwarded = howdou.get_forwarded_args(args)
+            self.assertEqual(forwarded['kb_filename'], os.path.join(os.path.realpath(self.tmp_dir), 'howdou.yml'))
+            response = howdou.send_to_daemon(self.socket_path, {'args': forwarded})
+            self.assertTrue('howdou --reindex' in response['output'])
+        finally:
+            os.chdir(cwd)
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')))
+
+    def test_force_reindex(self):
+        args = vars(get_parser().parse_args(['create', 'knowledge', 'base', 'entry'] + self.args))
+        self.assertTrue('howdou --reindex' in howdou.send_to_daemon(self.socket_path, {'args': args})['output'])
+
+        # A forced reindex in another process replaces the index, and the daemon must not keep answering from the old one.
+        hdu = HowDoU(**vars(get_parser().parse_args(['--action=reindex', '--force'] + self.args)))
+        with open(hdu.kb_filename, 'w') as fout:
+            fout.write(howdou.KNOWLEDGEBASE_STUB.replace('howdou --reindex', 'howdou --action=reindex'))
+        hdu.run()
+        output = howdou.send_to_daemon(self.socket_path, {'args': args})['output']
+        self.assertFalse('howdou --reindex' in output)
+        self.assertTrue('howdou --action=reindex' in output)
+
+    def test_timeout(self):
+        args = vars(get_parser().parse_args(['query'] + self.args))
+        self.assertEqual(howdou.get_daemon_timeout(args), howdou.DAEMON_TIMEOUT_MARGIN)
+        # A daemon fetching remote answers is given long enough for its requests to time out on every retry.
+        args = vars(get_parser().parse_args(['query', '--connect-timeout=1', '--read-timeout=2', '--retries=1']))
+        self.assertEqual(howdou.get_daemon_timeout(args), howdou.DAEMON_TIMEOUT_MARGIN + 2 * ((1 + 2) * 2 + 0.5))
+        args = vars(get_parser().parse_args(['query', '--daemon-timeout=0']))
+        self.assertEqual(howdou.get_daemon_timeout(args), None)
+
+    def test_formats(self):
+        for output_format in (howdou.JSON, howdou.NDJSON):
+            args = vars(get_parser().parse_args(
+                ['create', 'knowledge', 'base', 'entry', '--format=%s' % output_format] + self.args))
+            output = howdou.send_to_daemon(self.socket_path, {'args': args})['output']
+            self.assertFalse('--- Answer' in output)
+            if output_format == howdou.JSON:
+                answers = json.loads(output)
+            else:
+                answers = [json.loads(line) for line in output.splitlines()]
+            self.assertEqual(len(answers), 1)
+            self.assertTrue('howdou --reindex' in answers[0]['answer'])
+
+    def test_fallback(self):
+        self.daemon.terminate()
+        self.daemon.wait()
+        self.assertEqual(howdou.send_to_daemon(self.socket_path, {'ping': True}), None)
+
+    def test_stuck(self):
+        # A daemon that accepts connections but never answers is given up on.
+        socket_path = os.path.join(self.tmp_dir, 'stuck.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(socket_path)
+            server.listen(1)
+            t0 = time.time()
+            self.assertEqual(howdou.send_to_daemon(socket_path, {'ping': True}, timeout=0.2), None)
+            self.assertTrue(time.time() - t0 < 5)
+        finally:
+            server.close()
+
 class HowdouTestCaseEnvProxies(TestCase):
 
     def setUp(self):